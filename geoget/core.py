@@ -7,31 +7,51 @@ License: GPLv3+
 from __future__ import absolute_import, division
 
 from six import string_types
-from six.moves.urllib.request import urlretrieve, urlopen
+from six.moves import http_client
+from six.moves.urllib.request import getproxies, proxy_bypass
+from six.moves.urllib.parse import urlparse, urljoin
 from six.moves.urllib.error import HTTPError, URLError, ContentTooShortError
+from six.moves.http_client import IncompleteRead
 
 # Builtins
 import glob
 import os
-import gzip
 import shutil
 import zipfile
+import zlib
 import sys
-import math
 import json
 import time
 import fnmatch
+import io
+import socket
+import threading
+import uuid
+import warnings
+import tempfile
+import contextlib
+import functools
+import asyncio
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor
 
 # External libs
 import numpy as np
 import rasterio
 import psycopg2
 import pandas as pd
+import xarray as xr
+import netCDF4
 try:
     from rasterio.tools.merge import merge as merge_tool
 except ImportError:
     # rasterio V > 1.0
     from rasterio.merge import merge as merge_tool
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+import rasterio.shutil
+import shapely.geometry as shpg
 import filelock
 
 # Special regions for viewfinderpanoramas.org (Should be external!?)
@@ -55,6 +75,33 @@ DEM3REG = {
         # 'GL-East': [-42., -17., 64., 76.]
     }
 
+# Tiles with their own name inside the special regions above
+DEM3INSETS = {
+        # some weird inset files in Antarctica
+        'SR15': [-91., -90., -72., -68.],
+        'SP23': [-47., -43., -61., -60.],
+        'SQ58': [162., 165., -68., -66.],
+        # some Greenland tiles as GL-North is not rectangular
+        'U20': [-66., -60., 80., 83.],
+        'U21': [-60., -54., 80., 83.],
+        'U22': [-54., -48., 80., 83.],
+    }
+
+# Chunks of the CRU files converted for point and time series reads (see
+# get_cru_chunked_file): all time steps of 8x8 grid cells
+CRU_CHUNKS = {'lat': 8, 'lon': 8}
+
+# The tile catalogs read so far (see build_tile_catalog)
+_TILE_CATALOGS = dict()
+
+# Creation options of the Cloud Optimized GeoTIFFs (output_profile='COG').
+# The predictor is chosen after the data type (2 for integers, 3 for floats)
+COG_PROFILE = {
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'deflate',
+    }
+
 
 def mkdir(path, reset=False):
     """Checks if directory exists and if not, create one.
@@ -98,47 +145,596 @@ def onerror(func, path, exc_info):
         raise
 
 
-def get_download_lock(lock_dir):
-    mkdir(lock_dir)
-    lockfile = os.path.join(lock_dir, 'download.lock')
+def get_file_lock(path):
+    """Acquires a lock guarding a single target file.
+
+    The lock file is ``path + '.lock'``: two processes asking for the same
+    file wait on each other, while different files can be worked on at the
+    same time.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file to protect (it does not need to exist yet).
+    """
+    mkdir(os.path.dirname(os.path.abspath(path)))
+    lockfile = path + '.lock'
     try:
         return filelock.FileLock(lockfile).acquire()
     except:
         return filelock.SoftFileLock(lockfile).acquire()
 
 
-def _urlretrieve(url, ofile, *args, **kwargs):
+def get_download_lock(lock_dir):
+    """Acquires a lock on the file ``lock_dir/download``.
+
+    .. deprecated::
+        geoget no longer locks whole download directories: this lock does
+        not guard against its downloads any more. Use get_file_lock on the
+        file to protect instead.
+    """
+    warnings.warn('get_download_lock is deprecated: geoget locks each '
+                  'downloaded file instead (see get_file_lock).',
+                  DeprecationWarning, stacklevel=2)
+    return get_file_lock(os.path.join(lock_dir, 'download'))
+
+
+class _PooledResponse(object):
+    """File-like HTTP response giving its connection back to the pool."""
+
+    def __init__(self, session, key, conn, resp, url):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.url = url
+        self.status = resp.status
+        self.headers = resp.msg
+
+    def read(self, amt=None):
+        return self._resp.read(amt)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self._conn is None:
+            return
+        self._session._release(self._key, self._conn, self._resp)
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HTTPSession(object):
+    """A minimal thread-safe HTTP client with keep-alive connections.
+
+    Connections are pooled per (scheme, host, port) and reused by the next
+    requests to the same host, which saves the TCP and TLS handshakes when
+    many files are downloaded from the same server. Proxies are taken from
+    the environment, like ``urlopen`` does.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of idle connections kept per host.
+    timeout: float
+        Socket timeout in seconds.
+    max_redirects: int
+        Maximum number of redirects to follow.
+    """
+
+    def __init__(self, maxsize=8, timeout=60, max_redirects=10):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.headers = {'User-Agent': 'geoget'}
+        self._pool = dict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _new_conn(self, key):
+        scheme, host, port = key
+        proxy = getproxies().get(scheme)
+        if proxy and not proxy_bypass(host):
+            p = urlparse(proxy)
+            if scheme == 'https':
+                conn = http_client.HTTPSConnection(p.hostname, p.port,
+                                                   timeout=self.timeout)
+                conn.set_tunnel(host, port)
+            else:
+                conn = http_client.HTTPConnection(p.hostname, p.port,
+                                                  timeout=self.timeout)
+                # plain http proxies want the full URL
+                conn._geoget_proxy = True
+            return conn
+        if scheme == 'https':
+            return http_client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        return http_client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _get_conn(self, key):
+        """Returns (connection, whether it was reused)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the sockets belong to the parent
+                self._pool = dict()
+                self._pid = os.getpid()
+            conns = self._pool.get(key)
+            if conns:
+                return conns.pop(), True
+        return self._new_conn(key), False
+
+    def _release(self, key, conn, resp):
+        if not resp.isclosed() or resp.will_close:
+            # not entirely read or not keep-alive: cannot be reused
+            conn.close()
+            return
+        with self._lock:
+            conns = self._pool.setdefault(key, [])
+            if self._pid == os.getpid() and len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            pool, self._pool = self._pool, dict()
+        for conns in pool.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, key, url, headers):
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self._get_conn(key)
+            target = url if getattr(conn, '_geoget_proxy', False) else path
+            try:
+                conn.request('GET', target, headers=headers)
+                return conn, conn.getresponse()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                # the server might have closed an idle connection
+                if not reused:
+                    raise
+
+    def open(self, url, headers=None):
+        """Sends a GET request and returns the response.
+
+        Redirects are followed. As with ``urlopen``, HTTP errors raise an
+        ``HTTPError``. The response must be closed (e.g. with a ``with``
+        statement) to give the connection back to the pool.
+
+        Parameters
+        ----------
+        url: str
+            The URL to get.
+        headers: dict, optional
+            Additional request headers.
+
+        Returns
+        -------
+        A file-like response with ``read()``, ``info()`` and ``getcode()``.
+        """
+
+        hdrs = dict(self.headers)
+        if headers:
+            hdrs.update(headers)
+
+        for _ in range(self.max_redirects + 1):
+            p = urlparse(url)
+            if p.scheme not in ['http', 'https']:
+                raise URLError('Unsupported URL scheme: {}'.format(url))
+            port = p.port or (443 if p.scheme == 'https' else 80)
+            key = (p.scheme, p.hostname, port)
+            try:
+                conn, resp = self._request(key, url, hdrs)
+            except (http_client.HTTPException, socket.error) as err:
+                raise URLError(err)
+
+            location = resp.getheader('Location')
+            if resp.status in [301, 302, 303, 307, 308] and location:
+                resp.read()
+                self._release(key, conn, resp)
+                url = urljoin(url, location)
+                continue
+
+            if resp.status >= 400:
+                body = resp.read()
+                self._release(key, conn, resp)
+                raise HTTPError(url, resp.status, resp.reason, resp.msg,
+                                io.BytesIO(body))
+
+            return _PooledResponse(self, key, conn, resp, url)
+
+        raise HTTPError(url, resp.status, 'Too many redirects', resp.msg,
+                        None)
+
+
+_http_session = HTTPSession()
+
+
+def get_http_session():
+    """Returns the HTTPSession shared by all geoget downloads."""
+    return _http_session
+
+
+@contextlib.contextmanager
+def _atomic_output(path):
+    """Context manager yielding a temporary path to write `path` to.
+
+    The temporary file lives next to `path` and is renamed to it when the
+    block exits without error. Therefore, `path` is either complete or
+    absent, and readers can rely on ``os.path.exists(path)`` without lock.
+    """
+    tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
     try:
-        return urlretrieve(url, ofile, *args, **kwargs)
-    except:
-        if os.path.exists(ofile):
-            os.remove(ofile)
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _cog_options(output_profile):
+    """The creation options of an output profile: None for plain GeoTIFFs,
+    COG_PROFILE for 'COG', COG_PROFILE updated with the dict otherwise."""
+
+    if output_profile is None:
+        return None
+    if isinstance(output_profile, string_types):
+        if output_profile.upper() != 'COG':
+            raise ValueError('Output profile {} not available.'
+                             .format(output_profile))
+        output_profile = dict()
+    opts = dict(COG_PROFILE)
+    opts.update(output_profile)
+    opts['tiled'] = True
+    return opts
+
+
+def _to_cog(raw, path, opts):
+    """Copies the GeoTIFF raw to a tiled, compressed GeoTIFF with internal
+    overviews (halving the resolution down to about the size of a tile)."""
+
+    opts = dict(opts)
+    with rasterio.open(raw, 'r+') as ds:
+        block = min(opts['blockxsize'], opts['blockysize'])
+        size = max(ds.width, ds.height)
+        factors = []
+        f = 2
+        while size / f >= block:
+            factors.append(f)
+            f *= 2
+        if factors:
+            ds.build_overviews(factors, Resampling.average)
+        if 'predictor' not in opts and \
+                str(opts.get('compress')).lower() in ['deflate', 'lzw']:
+            float_data = np.issubdtype(np.dtype(ds.dtypes[0]), np.floating)
+            opts['predictor'] = 3 if float_data else 2
+    rasterio.shutil.copy(raw, path, driver='GTiff', copy_src_overviews=True,
+                         **opts)
+
+
+@contextlib.contextmanager
+def _raster_output(path, output_profile=None):
+    """Same as _atomic_output, for the rasters written by geoget.
+
+    With an output profile (see get_topo_file), the GeoTIFF written to the
+    yielded path is converted to a Cloud Optimized GeoTIFF before it
+    appears at `path`.
+    """
+    opts = _cog_options(output_profile)
+    with _atomic_output(path) as tmp:
+        if opts is None:
+            yield tmp
+            return
+        raw = tmp + '.raw'
+        try:
+            yield raw
+            _to_cog(raw, tmp, opts)
+        finally:
+            if os.path.exists(raw):
+                os.remove(raw)
+
+
+def _extract_zip(zfile, outdir):
+    """Extracts an archive so that each of its members appears atomically.
+
+    The archive is first extracted in a temporary directory within `outdir`,
+    then the files are renamed to their final location.
+    """
+    mkdir(outdir)
+    tmpdir = tempfile.mkdtemp(prefix='.extract_', dir=outdir)
+    try:
+        with zipfile.ZipFile(zfile) as zf:
+            zf.extractall(tmpdir)
+        for root, dirs, files in os.walk(tmpdir):
+            odir = os.path.relpath(root, tmpdir)
+            odir = os.path.normpath(os.path.join(outdir, odir))
+            mkdir(odir)
+            for f in files:
+                os.replace(os.path.join(root, f), os.path.join(odir, f))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _read_part_info(part):
+    """The (validator, total size) of the file a part file belongs to,
+    (None, -1) if unknown."""
+    info = _read_json(part + '.json')
+    return info.get('validator'), info.get('size', -1)
+
+
+def _write_part_info(part, validator, size):
+    """Remembers the (validator, total size) of the file a part file belongs
+    to, to check that it did not change when the download is continued."""
+    with _atomic_output(part + '.json') as tmp:
+        with open(tmp, 'w') as f:
+            json.dump({'validator': validator, 'size': size}, f)
+
+
+def _validator(headers):
+    """The value for If-Range: the strong ETag or the Last-Modified date."""
+    etag = headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _remove_part(part):
+    for f in [part, part + '.json']:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def _urlretrieve_part(url, ofile, reporthook=None, block_size=1024*64):
+    """Downloads `url` into ``ofile + '.part'``, continuing it if present.
+
+    The range request of a continued download carries the validator of the
+    first response (If-Range), and the total size of the file is checked:
+    if the remote file changed in between, it is downloaded again.
+
+    Returns the response headers once the part file is complete. The part
+    file is kept if anything goes wrong.
+    """
+
+    part = ofile + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    validator, size = _read_part_info(part)
+    if offset > 0 and validator is None and size < 0:
+        # nothing to check that the remote file is still the same
+        _remove_part(part)
+        offset = 0
+
+    headers = dict()
+    if offset > 0:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        if validator is not None:
+            headers['If-Range'] = validator
+    try:
+        resp = get_http_session().open(url, headers=headers)
+    except HTTPError as err:
+        if offset > 0 and err.code == 416:
+            # the range starts after the end: the part file is complete if
+            # the server size matches, otherwise it is garbage
+            crange = err.headers.get('Content-Range', '')
+            if crange == 'bytes */{}'.format(offset) and size == offset:
+                return err.headers
+            _remove_part(part)
+            return _urlretrieve_part(url, ofile, reporthook=reporthook,
+                                     block_size=block_size)
         raise
 
+    with contextlib.closing(resp):
+        headers = resp.info()
+        crange = headers.get('Content-Range', '')
+        if offset > 0 and resp.getcode() == 206:
+            if not (crange.startswith('bytes {}-'.format(offset)) and
+                    (size < 0 or crange.endswith('/{}'.format(size)))):
+                # not the part we expected (the file changed?)
+                _remove_part(part)
+                return _urlretrieve_part(url, ofile, reporthook=reporthook,
+                                         block_size=block_size)
+            mode = 'ab'
+        else:
+            # the server ignored the range (or the file changed): start
+            # from scratch
+            offset = 0
+            mode = 'wb'
+
+        total = int(headers.get('Content-Length', -1))
+        if total >= 0:
+            total += offset
+        if mode == 'wb':
+            _write_part_info(part, _validator(headers), total)
+
+        read = offset
+        blocknum = offset // block_size
+        with open(part, mode) as f:
+            if reporthook:
+                reporthook(blocknum, block_size, total)
+            while True:
+                block = resp.read(block_size)
+                if not block:
+                    break
+                f.write(block)
+                read += len(block)
+                blocknum += 1
+                if reporthook:
+                    reporthook(blocknum, block_size, total)
+
+    if 0 <= total and read < total:
+        raise ContentTooShortError('retrieval incomplete: got only {} out of '
+                                   '{} bytes'.format(read, total),
+                                   (part, headers))
+    return headers
+
+
+def _urlretrieve(url, ofile, reporthook=None, retry=3):
+    """Downloads `url` to `ofile`.
+
+    The data is written to ``ofile + '.part'``, which is renamed to `ofile`
+    once complete. If the transfer is interrupted, it is continued with an
+    HTTP Range request, now (up to `retry` times) or at the next call.
+    Servers ignoring ranges get a full download.
+    """
 
-def progress_urlretrieve(url, ofile):
-    print("Downloading %s ..." % url)
-    sys.stdout.flush()
+    retry_counter = 0
+    while True:
+        try:
+            headers = _urlretrieve_part(url, ofile, reporthook=reporthook)
+            break
+        except (ContentTooShortError, IncompleteRead, socket.timeout,
+                ConnectionError):
+            retry_counter += 1
+            if retry_counter > retry:
+                raise
+            print("Download of %s interrupted, resuming... %s/%s" %
+                  (url, retry_counter, retry))
+
+    os.replace(ofile + '.part', ofile)
+    _remove_part(ofile + '.part')
+    return ofile, headers
+
+
+@contextlib.contextmanager
+def _progress_bar():
+    """Yields a ``reporthook(count, size, total)`` drawing a progress bar,
+    or None if the progressbar package is not available."""
     try:
         from progressbar import DataTransferBar, UnknownLength
-        pbar = DataTransferBar()
+    except ImportError:
+        yield None
+        return
+    pbar = DataTransferBar()
+
+    def _upd(count, size, total):
+        if pbar.max_value is None:
+            if total > 0:
+                pbar.start(total)
+            else:
+                pbar.start(UnknownLength)
+        pbar.update(min(count * size, total))
+        sys.stdout.flush()
+    yield _upd
+    try:
+        pbar.finish()
+    except:
+        pass
 
-        def _upd(count, size, total):
-            if pbar.max_value is None:
-                if total > 0:
-                    pbar.start(total)
-                else:
-                    pbar.start(UnknownLength)
-            pbar.update(min(count * size, total))
-            sys.stdout.flush()
-        res = _urlretrieve(url, ofile, reporthook=_upd)
+
+def _urlretrieve_gunzip(url, ofile, reporthook=None, retry=3):
+    """Downloads the gzip file at `url` to `ofile`, decompressed.
+
+    The response is decompressed as it arrives (see _gunzip) into the
+    atomically written `ofile`: the compressed file is never stored. An
+    interrupted transfer has nothing to resume from, and is started again
+    (up to `retry` times).
+    """
+
+    retry_counter = 0
+    while True:
         try:
-            pbar.finish()
-        except:
-            pass
-        return res
-    except ImportError:
-        return _urlretrieve(url, ofile)
+            with contextlib.closing(get_http_session().open(url)) as resp:
+                headers = resp.info()
+                total = int(headers.get('Content-Length', -1))
+                with _atomic_output(ofile) as tmp:
+                    with open(tmp, 'wb') as f:
+                        _gunzip(resp, f, total=total, reporthook=reporthook)
+            return ofile, headers
+        except (EOFError, IncompleteRead, socket.timeout, ConnectionError):
+            retry_counter += 1
+            if retry_counter > retry:
+                raise
+            print("Download of %s interrupted, restarting... %s/%s" %
+                  (url, retry_counter, retry))
+
+
+def progress_urlretrieve(url, ofile, gunzip=False):
+    """Downloads `url` to `ofile` with a progress bar (if available).
+
+    If `gunzip` is set, `url` is a gzip file, which is decompressed to
+    `ofile` while it is downloaded (see _urlretrieve_gunzip).
+    """
+    print("Downloading %s ..." % url)
+    sys.stdout.flush()
+    with _progress_bar() as hook:
+        if gunzip:
+            return _urlretrieve_gunzip(url, ofile, reporthook=hook)
+        return _urlretrieve(url, ofile, reporthook=hook)
+
+
+def _gunzip(fsrc, fdst, total=-1, reporthook=None, block_size=2**20):
+    """Decompresses the gzip data of the file object `fsrc` into `fdst`.
+
+    The data is read and written in blocks of at most `block_size` bytes,
+    whatever its content: `fsrc` can also be a download in progress.
+    Concatenated gzip members are decompressed one after the other, and
+    zero bytes padding the end of a member are skipped (as in gzip). zlib
+    checks the CRC and the decompressed size stored at the end of each
+    member (raising zlib.error), and an EOFError is raised if the data is
+    truncated.
+
+    `reporthook(blocknum, block_size, total)` is called after each block
+    read, as in urlretrieve, with `total` the compressed size if known.
+
+    Returns the decompressed size.
+    """
+
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False
+    members = 0
+    size = 0
+    blocknum = 0
+    if reporthook:
+        reporthook(blocknum, block_size, total)
+    while True:
+        block = fsrc.read(block_size)
+        data = block
+        while True:
+            if not in_member:
+                # padding, or the start of the next member
+                data = data.lstrip(b'\0')
+                if not data:
+                    break
+                in_member = True
+            out = d.decompress(data, block_size)
+            fdst.write(out)
+            size += len(out)
+            if d.eof:
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                in_member = False
+                members += 1
+                continue
+            data = d.unconsumed_tail
+            if not data and len(out) < block_size:
+                break
+        if not block:
+            break
+        blocknum += 1
+        if reporthook:
+            reporthook(blocknum, block_size, total)
+
+    if in_member or members == 0:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached')
+    return size
 
 
 def empty_cache(cdir):
@@ -249,7 +845,7 @@ def _download_gh_sample_files_unlocked(repo=None, outdir=None):
         write_sha = True
         try:
             # this might fail with HTTP 403 when server overload
-            resp = urlopen(master_sha_url)
+            resp = get_http_session().open(master_sha_url)
 
             # following try/finally is just for py2/3 compatibility
             # https://mail.python.org/pipermail/python-list/2016-March/704073.html
@@ -273,20 +869,19 @@ def _download_gh_sample_files_unlocked(repo=None, outdir=None):
 
         # Trying to make the download more robust
         try:
-            with zipfile.ZipFile(ofile) as zf:
-                zf.extractall(odir)
+            _extract_zip(ofile, odir)
         except zipfile.BadZipfile:
             # try another time
             if os.path.exists(ofile):
                 os.remove(ofile)
             progress_urlretrieve(master_zip_url, ofile)
-            with zipfile.ZipFile(ofile) as zf:
-                zf.extractall(odir)
+            _extract_zip(ofile, odir)
 
     # sha did change, replace
     if write_sha:
-        with open(shafile, 'w') as sfile:
-            sfile.write(master_sha)
+        with _atomic_output(shafile) as tmp:
+            with open(tmp, 'w') as sfile:
+                sfile.write(master_sha)
 
     # list of files for output
     out = dict()
@@ -305,7 +900,262 @@ def _download_gh_sample_files_unlocked(repo=None, outdir=None):
     return out
 
 
-def download_srtm_file(zone, outdir):
+def _read_json(path):
+    """Reads a JSON file, returning an empty dict if not there."""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def _update_json(path, func):
+    """Modifies a JSON file in place with ``func(dict)``, safely."""
+    with get_file_lock(path):
+        d = _read_json(path)
+        func(d)
+        with _atomic_output(path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(d, f, indent=0, sort_keys=True)
+
+
+def _is_missing_tile(outdir, fname, expiry=None):
+    """Checks if a file was recorded as missing on the server.
+
+    Parameters
+    ----------
+    outdir: str
+        The download directory.
+    fname: str
+        The name of the downloaded file (e.g. 'srtm_41_20.zip').
+    expiry: float, optional
+        Entries older than this (in seconds) are ignored. The default is to
+        trust them forever.
+    """
+    t = _read_json(os.path.join(outdir, 'missing_tiles.json')).get(fname)
+    if t is None:
+        return False
+    return expiry is None or (time.time() - t) < expiry
+
+
+def _record_missing_tile(outdir, fname):
+    """Remembers that a file does not exist on the server (e.g. oceans)."""
+
+    def _add(d):
+        d[fname] = time.time()
+    _update_json(os.path.join(outdir, 'missing_tiles.json'), _add)
+
+
+def _grid_zones(source):
+    """All the zones a DEM source could have, in the order of the bits of
+    the tile catalog."""
+
+    if source == 'SRTM':
+        return ['{:02d}_{:02d}'.format(zx, zy)
+                for zx in range(1, 73) for zy in range(1, 25)]
+    if source == 'DEM3':
+        # 23 rows of 4 degrees on each side of the equator, then the tiles
+        # with their own name
+        zones = ['%s%s%02d' % (hemi, chr(zy + ord('A')), zx)
+                 for hemi in ['', 'S'] for zy in range(23)
+                 for zx in range(1, 61)]
+        names = set(zones)
+        zones.extend(sorted(z for z in list(DEM3REG) + list(DEM3INSETS)
+                            if z not in names))
+        return zones
+    raise ValueError('No tile catalog for DEM source {}.'.format(source))
+
+
+def build_tile_catalog(source, zones, outdir):
+    """
+    Writes the tiles existing on the server of a DEM source in the tile
+    catalog of a download directory.
+
+    The catalog (``outdir/tile_catalog.json``) stores, for each source, a
+    bitmap over all the possible tiles (see _grid_zones). The tiles it does
+    not list are considered as missing, without asking the server (see
+    download_srtm_file). Without catalog, all tiles are asked for.
+
+    Parameters
+    ----------
+    source: str
+        'SRTM' or 'DEM3'.
+    zones: list of str
+        The existing tiles (e.g. from a listing of the server).
+    outdir: str
+        The download directory.
+    """
+
+    grid = _grid_zones(source)
+    unknown = set(zones).difference(grid)
+    if unknown:
+        raise ValueError('Unknown {} zones: {}'.format(source,
+                                                      sorted(unknown)))
+    bits = np.isin(grid, list(zones))
+    entry = dict(size=len(grid), bitmap=np.packbits(bits).tobytes().hex())
+
+    def _set(d):
+        d[source] = entry
+    mkdir(outdir)
+    _update_json(os.path.join(outdir, 'tile_catalog.json'), _set)
+
+
+def _read_tile_catalog(path, source):
+    """The set of the tiles of a source in a catalog file, None if the
+    source is not in it (or if its grid changed since)."""
+
+    entry = _read_json(path).get(source)
+    grid = _grid_zones(source)
+    if entry is None or entry['size'] != len(grid):
+        return None
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex(entry['bitmap']),
+                                       dtype=np.uint8))[:len(grid)]
+    return set(z for z, b in zip(grid, bits) if b)
+
+
+def _in_tile_catalog(outdir, zone, source):
+    """Checks if a tile exists according to the tile catalog of outdir. All
+    tiles do if the source has no catalog."""
+
+    path = os.path.join(outdir, 'tile_catalog.json')
+    try:
+        key = (path, os.path.getmtime(path), source)
+    except OSError:
+        return True
+    if key not in _TILE_CATALOGS:
+        _TILE_CATALOGS[key] = _read_tile_catalog(path, source)
+    tiles = _TILE_CATALOGS[key]
+    return tiles is None or zone in tiles
+
+
+def _touch_product(outdir, path, bounds=None, refs=None, zones=None):
+    """Records the size and the time of last use of a derived product (e.g.
+    a merged DEM) in ``outdir/cache_index.json``, and, if given, its bounds,
+    the tiles its pixels come from and the other products it references
+    (VRT)."""
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        # removed by another process in the meantime
+        return
+    key = os.path.relpath(path, outdir)
+
+    def _touch(d):
+        entry = d.setdefault(key, dict())
+        entry.update(size=size, atime=time.time())
+        if bounds is not None:
+            entry['bounds'] = [float(b) for b in bounds]
+        if zones is not None:
+            entry['zones'] = sorted(zones)
+        if refs:
+            entry['refs'] = [os.path.relpath(r, outdir) for r in refs]
+    _update_json(os.path.join(outdir, 'cache_index.json'), _touch)
+
+
+def _remove_lock_file(path):
+    """Removes the lock file of get_file_lock(path), if there."""
+    try:
+        os.remove(path + '.lock')
+    except OSError:
+        pass
+
+
+def trim_cache(outdir, max_size, keep=None):
+    """
+    Removes the least recently used derived products of a cache directory.
+
+    Only the products recorded in ``outdir/cache_index.json`` (the merged
+    DEMs) are candidates: the downloaded tiles and archives are never
+    removed. Products being written are skipped. The products referencing a
+    removed one (VRT) are removed with it.
+
+    Parameters
+    ----------
+    outdir: str
+        The cache directory.
+    max_size: int
+        The disk budget of the products, in bytes.
+    keep: list of str, optional
+        Paths of products not to remove (e.g. the ones in use).
+
+    Returns
+    -------
+    The list of the removed files.
+    """
+
+    keep = [os.path.abspath(k) for k in (keep or [])]
+    removed = []
+
+    def _trim(d):
+        # forget the products removed by others
+        for key in list(d.keys()):
+            if not os.path.exists(os.path.join(outdir, key)):
+                del d[key]
+        total = sum(e['size'] for e in d.values())
+        # the products used by the kept ones are kept as well
+        kept = set(k for k in d.keys()
+                   if os.path.abspath(os.path.join(outdir, k)) in keep)
+        kept.update(r for k in list(kept) for r in d[k].get('refs', []))
+        for key in sorted(d.keys(), key=lambda k: d[k]['atime']):
+            if total <= max_size:
+                break
+            if key not in d or key in kept:
+                continue
+            path = os.path.join(outdir, key)
+            # (the writers hold the lock of get_file_lock)
+            lock = filelock.FileLock(path + '.lock')
+            try:
+                lock.acquire(timeout=0)
+            except filelock.Timeout:
+                continue
+            try:
+                os.remove(path)
+                # (waiting writers see that the product is gone)
+                _remove_lock_file(path)
+            except OSError:
+                # still open (Windows)
+                continue
+            finally:
+                lock.release()
+            total -= d.pop(key)['size']
+            removed.append(path)
+            for dep in [k for k, e in d.items() if key in e.get('refs', [])]:
+                dep_path = os.path.join(outdir, dep)
+                try:
+                    os.remove(dep_path)
+                    removed.append(dep_path)
+                    _remove_lock_file(dep_path)
+                except OSError:
+                    pass
+                total -= d.pop(dep)['size']
+
+    _update_json(os.path.join(outdir, 'cache_index.json'), _trim)
+    return removed
+
+
+def _check_storage(storage):
+    """Raises a ValueError for unknown tile storage modes."""
+    if storage not in ['extract', 'zip']:
+        raise ValueError('Storage mode {} not available.'.format(storage))
+
+
+def _vsizip_members(zfile, dirname=None, ext='.tif'):
+    """The GDAL /vsizip/ paths of the files in an archive.
+
+    Only the members with the extension `ext` (and in the directory
+    `dirname`, if given) are returned. Raises zipfile.BadZipfile if zfile
+    is not an archive.
+    """
+    with zipfile.ZipFile(zfile) as zf:
+        names = [n for n in zf.namelist() if n.lower().endswith(ext)]
+    if dirname is not None:
+        names = [n for n in names if os.path.dirname(n) == dirname]
+    zfile = os.path.abspath(zfile).replace(os.sep, '/')
+    return ['/vsizip/' + zfile + '/' + n for n in sorted(names)]
+
+
+def download_srtm_file(zone, outdir, missing_expiry=None, storage='extract'):
     """
     Download an SRTM file of a specified zone.
     
@@ -315,16 +1165,38 @@ def download_srtm_file(zone, outdir):
         A valid SRTM zone
     outdir: str
         Directory where to store the SRTM file 
+    missing_expiry: float, optional
+        Tiles not found on the server (oceans) are remembered in
+        ``outdir/missing_tiles.json``. After this number of seconds the
+        server is asked again. The default is to never ask again. The
+        tiles missing from the tile catalog of outdir (see
+        build_tile_catalog) are never asked for.
+    storage: str, optional
+        'extract' (default) extracts the GeoTIFF from the downloaded archive.
+        'zip' keeps only the archive on disk, and returns the GDAL
+        ``/vsizip/`` path of the GeoTIFF inside it: it is decompressed
+        lazily, when read. A tile already extracted is used as it is.
 
     Returns
     -------
-    Path to the downloaded SRTM file.
+    Path to the downloaded SRTM file, None if the tile does not exist.
     """
-    with get_download_lock(outdir):
-        return _download_srtm_file_unlocked(zone, outdir)
 
+    _check_storage(storage)
+
+    # files are written atomically: no need to lock if already there
+    out = os.path.join(outdir, 'srtm_' + zone + '.tif')
+    if os.path.exists(out):
+        return out
+    if not _in_tile_catalog(outdir, zone, 'SRTM') or \
+            _is_missing_tile(outdir, 'srtm_' + zone + '.zip', missing_expiry):
+        return None
+
+    with get_file_lock(os.path.join(outdir, 'srtm_' + zone + '.zip')):
+        return _download_srtm_file_unlocked(zone, outdir, storage=storage)
 
-def _download_srtm_file_unlocked(zone, outdir, retry=5):
+
+def _download_srtm_file_unlocked(zone, outdir, retry=5, storage='extract'):
     """Check if the srtm data is already in the directory. If not, download it.
     """
 
@@ -333,21 +1205,28 @@ def _download_srtm_file_unlocked(zone, outdir, retry=5):
 #    ifile = 'http://srtm.csi.cgiar.org/SRT-ZIP/SRTM_V41/SRTM_Data_GeoTiff' \
     ifile = 'http://droppr.org/srtm/v4.1/6_5x5_TIFs' \
             '/srtm_' + zone + '.zip'
-    if not os.path.exists(ofile):
+    out = os.path.join(outdir, 'srtm_' + zone + '.tif')
+    if not os.path.exists(out):
         retry_counter = 0
         retry_max = retry
         while True:
             # Try to download
             try:
                 retry_counter += 1
-                progress_urlretrieve(ifile, ofile)
-                with zipfile.ZipFile(ofile) as zf:
-                    zf.extractall(outdir)
+                if not os.path.exists(ofile):
+                    progress_urlretrieve(ifile, ofile)
+                if storage == 'zip':
+                    members = _vsizip_members(ofile)
+                    if not members:
+                        raise RuntimeError('No GeoTIFF in ' + ofile)
+                    return members[0]
+                _extract_zip(ofile, outdir)
                 break
             except HTTPError as err:
                 # This works well for py3
                 if err.code == 404:
                     # Ok so this *should* be an ocean tile
+                    _record_missing_tile(outdir, os.path.basename(ofile))
                     return None
                 elif (500 <= err.code < 600) and retry_counter <= retry_max:
                     print("Downloading SRTM data failed with HTTP error %s, "
@@ -358,16 +1237,18 @@ def _download_srtm_file_unlocked(zone, outdir, retry=5):
                 else:
                     raise
             except zipfile.BadZipfile:
-                # This is for py2
-                # Ok so this *should* be an ocean tile
+                # not an archive (an error page, or truncated): not a proof
+                # that the tile is missing, it is downloaded again next time
+                os.remove(ofile)
                 return None
 
-    out = os.path.join(outdir, 'srtm_' + zone + '.tif')
     assert os.path.exists(out)
     return out
 
 
-def download_dem3_viewpano(zone, outdir):
+def download_dem3_viewpano(zone, outdir, missing_expiry=None,
+                           max_memory=None, output_profile=None,
+                           storage='extract'):
     """
     Download a viewfinderpanoramas.org file of a specified zone.
     
@@ -377,16 +1258,51 @@ def download_dem3_viewpano(zone, outdir):
         A valid zone from viewfinderpanoramas.org
     outdir: str
         The directory where to store the download
+    missing_expiry: float, optional
+        Tiles not found on the server (oceans) are remembered in
+        ``outdir/missing_tiles.json``. After this number of seconds the
+        server is asked again. The default is to never ask again. The
+        tiles missing from the tile catalog of outdir (see
+        build_tile_catalog) are never asked for.
+    max_memory: int, optional
+        The single .hgt files of a zone are merged in one GeoTIFF. If set,
+        this is done block by block using about this many bytes of memory,
+        instead of all at once (see get_topo_file).
+    output_profile: str or dict, optional
+        The GeoTIFF profile of these merged zones (see get_topo_file).
+    storage: str, optional
+        'extract' (default) extracts the .hgt files of the archive and merges
+        them in a GeoTIFF. 'zip' keeps only the archive on disk, and returns
+        a GDAL virtual mosaic (``zone.vrt``) of the ``/vsizip/`` paths of the
+        .hgt files inside it. A zone already merged is used as it is.
 
     Returns
     -------
-    The path to the downloaded viewfinderpanoramas.org file
+    The path to the downloaded viewfinderpanoramas.org file, None if the tile
+    does not exist.
     """
-    with get_download_lock(outdir):
-        return _download_dem3_viewpano_unlocked(zone, outdir)
 
+    _check_storage(storage)
+
+    # files are written atomically: no need to lock if already there
+    outpath = os.path.join(outdir, zone + '.tif')
+    if os.path.exists(outpath):
+        return outpath
+    vrtpath = os.path.join(outdir, zone + '.vrt')
+    if storage == 'zip' and os.path.exists(vrtpath):
+        return vrtpath
+    if not _in_tile_catalog(outdir, zone, 'DEM3') or \
+            _is_missing_tile(outdir, 'dem3_' + zone + '.zip', missing_expiry):
+        return None
 
-def _download_dem3_viewpano_unlocked(zone, outdir):
+    with get_file_lock(os.path.join(outdir, 'dem3_' + zone + '.zip')):
+        return _download_dem3_viewpano_unlocked(
+            zone, outdir, max_memory=max_memory,
+            output_profile=output_profile, storage=storage)
+
+
+def _download_dem3_viewpano_unlocked(zone, outdir, max_memory=None,
+                                     output_profile=None, storage='extract'):
     """Checks if the srtm data is in the directory and if not, download it.
     """
 
@@ -397,6 +1313,9 @@ def _download_dem3_viewpano_unlocked(zone, outdir):
     # check if TIFF file exists already
     if os.path.exists(outpath):
         return outpath
+    vrtpath = os.path.join(outdir, zone + '.vrt')
+    if storage == 'zip' and os.path.exists(vrtpath):
+        return vrtpath
 
     # some files have a newer version 'v2'
     if zone in ['R33', 'R34', 'R35', 'R36', 'R37', 'R38', 'Q32', 'Q33', 'Q34',
@@ -416,13 +1335,12 @@ def _download_dem3_viewpano_unlocked(zone, outdir):
             try:
                 retry_counter += 1
                 progress_urlretrieve(ifile, ofile)
-                with zipfile.ZipFile(ofile) as zf:
-                    zf.extractall(outdir)
                 break
             except HTTPError as err:
                 # This works well for py3
                 if err.code == 404:
                     # Ok so this *should* be an ocean tile
+                    _record_missing_tile(outdir, os.path.basename(ofile))
                     return None
                 elif (500 <= err.code < 600) and retry_counter <= retry_max:
                     print("Downloading DEM3 data failed with HTTP error %s, "
@@ -433,16 +1351,32 @@ def _download_dem3_viewpano_unlocked(zone, outdir):
                 else:
                     raise
             except ContentTooShortError:
+                if retry_counter > retry_max:
+                    raise
                 print("Downloading DEM3 data failed with ContentTooShortError"
-                      " error %s, retrying in 10 seconds... %s/%s" %
-                      (err.code, retry_counter, retry_max))
+                      ", retrying in 10 seconds... %s/%s" %
+                      (retry_counter, retry_max))
                 time.sleep(10)
                 continue
 
-            except zipfile.BadZipfile:
-                # This is for py2
-                # Ok so this *should* be an ocean tile
-                return None
+    # the archive is only read now, so that it is also done for archives
+    # downloaded earlier in the other storage mode
+    try:
+        if storage == 'zip':
+            members = _vsizip_members(ofile, ext='.hgt')
+        else:
+            # in a directory of our own: southern archives are extracted in
+            # the folder of the northern ones (see below), which might be
+            # merged at the same time
+            exdir = tempfile.mkdtemp(prefix='.extract_', dir=outdir)
+            with zipfile.ZipFile(ofile) as zf:
+                zf.extractall(exdir)
+                members = [n for n in zf.namelist() if n.endswith('.hgt')]
+    except zipfile.BadZipfile:
+        # not an archive (an error page, or truncated): not a proof that the
+        # tile is missing, it is downloaded again next time
+        os.remove(ofile)
+        return None
 
     # Serious issue: sometimes, if a southern hemisphere URL is queried for
     # download and there is none, a NH zip file os downloaded.
@@ -451,42 +1385,59 @@ def _download_dem3_viewpano_unlocked(zone, outdir):
     # the unzipped folder has the file name of
     # the northern hemisphere file. Some checks if correct file exists:
     if len(zone) == 4 and zone.startswith('S'):
-        zonedir = os.path.join(outdir, zone[1:])
+        dirname = zone[1:]
     else:
-        zonedir = os.path.join(outdir, zone)
-    globlist = glob.glob(os.path.join(zonedir, '*.hgt'))
+        dirname = zone
+
+    if storage == 'zip':
+        # the special file naming cases take all files of the archive
+        if zone not in DEM3REG.keys():
+            members = [m for m in members
+                       if os.path.basename(os.path.dirname(m)) == dirname]
+        if not members:
+            raise RuntimeError("We should have some files here, but we "
+                               "don't")
+        _write_vrt(members, vrtpath)
+        return vrtpath
 
-    # take care of the special file naming cases
-    if zone in DEM3REG.keys():
-        globlist = glob.glob(os.path.join(outdir, '*', '*.hgt'))
+    try:
+        # (sorted, so that the overlapping edges are always taken from the
+        # same file)
+        globlist = sorted(glob.glob(os.path.join(exdir, dirname, '*.hgt')))
+
+        # take care of the special file naming cases
+        if zone in DEM3REG.keys():
+            globlist = [os.path.join(exdir, n) for n in sorted(members)]
+
+        if not globlist:
+            raise RuntimeError("We should have some files here, but we "
+                               "don't")
+
+        # merge the single HGT files (can be a bit ineffective, because not
+        # every single file might be exactly within extent...)
+        _merge_topo_files(globlist, outpath, max_memory=max_memory,
+                          output_profile=output_profile)
+    finally:
+        # delete original files to spare disk space (Can cause problems on
+        # Windows, that's why the errors are ignored)
+        shutil.rmtree(exdir, ignore_errors=True)
 
-    if not globlist:
-        raise RuntimeError("We should have some files here, but we don't")
+    assert os.path.exists(outpath)
+    return outpath
 
-    # merge the single HGT files (can be a bit ineffective, because not every
-    # single file might be exactly within extent...)
-    rfiles = [rasterio.open(s) for s in globlist]
-    dest, output_transform = merge_tool(rfiles)
-    profile = rfiles[0].profile
-    if 'affine' in profile:
-        profile.pop('affine')
-    profile['transform'] = output_transform
-    profile['height'] = dest.shape[1]
-    profile['width'] = dest.shape[2]
-    profile['driver'] = 'GTiff'
-    with rasterio.open(outpath, 'w', **profile) as dst:
-        dst.write(dest)
 
-    assert os.path.exists(outpath)
-    # delete original files to spare disk space (Can cause problems on Windows
-    # that's why try/except
-    try:
-        for s in globlist:
-            os.remove(s)
-    except PermissionError:
-        pass
+def _download_zones(download_func, zones, outdir, max_workers=None):
+    """Calls ``download_func(zone, outdir)`` for each zone.
 
-    return outpath
+    If `max_workers` is larger than one, the zones are fetched concurrently
+    in a thread pool. The output list is in the same order as `zones`.
+    """
+
+    if max_workers is None or max_workers <= 1 or len(zones) <= 1:
+        return [download_func(z, outdir) for z in zones]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(zones))) as ex:
+        return list(ex.map(lambda z: download_func(z, outdir), zones))
 
 
 def _download_aster_file():
@@ -497,6 +1448,18 @@ def _download_alternate_topo_file():
     raise NotImplementedError()
 
 
+def _extent_ranges(lon_ex, lat_ex):
+    """Returns the (lon_min, lon_max, lat_min, lat_max) arrays of a batch of
+    extents. A single extent gives arrays of size one."""
+
+    lon_ex = np.atleast_2d(np.asarray(lon_ex, dtype=float))
+    lat_ex = np.atleast_2d(np.asarray(lat_ex, dtype=float))
+    if lon_ex.shape[0] != lat_ex.shape[0]:
+        raise ValueError('lon_ex and lat_ex must have the same length')
+    return (lon_ex.min(axis=1), lon_ex.max(axis=1),
+            lat_ex.min(axis=1), lat_ex.max(axis=1))
+
+
 def srtm_zone(lon_ran, lat_ran):
     """
     Find the related SRTM zone(s) given latitude/longitude ranges.
@@ -512,29 +1475,122 @@ def srtm_zone(lon_ran, lat_ran):
     -------
     A list of SRTM zones coinciding with the given latitude/longitude range.
     """
+    return srtm_zones(lon_ran, lat_ran)[0]
+
+
+def srtm_zones(lon_ex, lat_ex):
+    """
+    Find the SRTM zones of many extents at once.
+
+    Parameters
+    ----------
+    lon_ex: array-like
+        (N, 2) array of (min_lon, max_lon) longitude ranges
+    lat_ex: array-like
+        (N, 2) array of (min_lat, max_lat) latitude ranges
 
-    # SRTM are sorted in tiles of 5 degrees
+    Returns
+    -------
+    A list of N sorted lists of SRTM zones, one for each extent.
+    """
+
+    # SRTM are sorted in tiles of 5 degrees, the first one is at -180, 60.
+    # Tile (zx, zy) covers ]x0 + (zx-1) * 5, x0 + zx * 5] and
+    # [y0 - zy * 5, y0 - (zy-1) * 5[ (a point on an edge is in the west/north)
     srtm_x0 = -180.
     srtm_y0 = 60.
     srtm_dx = 5.
-    srtm_dy = -5.
-
-    # quick n dirty solution to be sure that we will cover the whole range
-    mi, ma = np.min(lon_ran), np.max(lon_ran)
-    lon_ran = np.linspace(mi, ma, int(np.ceil((ma - mi) + 3)))
-    mi, ma = np.min(lat_ran), np.max(lat_ran)
-    lat_ran = np.linspace(mi, ma, int(np.ceil((ma - mi) + 3)))
-
-    zones = []
-    for lon in lon_ran:
-        for lat in lat_ran:
-            dx = lon - srtm_x0
-            dy = lat - srtm_y0
-            assert dy < 0
-            zx = np.ceil(dx / srtm_dx)
-            zy = np.ceil(dy / srtm_dy)
-            zones.append('{:02.0f}_{:02.0f}'.format(zx, zy))
-    return list(sorted(set(zones)))
+    srtm_dy = 5.
+
+    lon_mi, lon_ma, lat_mi, lat_ma = _extent_ranges(lon_ex, lat_ex)
+    assert np.all(lat_ma < srtm_y0)
+
+    x0 = np.clip(np.ceil((lon_mi - srtm_x0) / srtm_dx), 1, 72).astype(int)
+    x1 = np.clip(np.ceil((lon_ma - srtm_x0) / srtm_dx), 1, 72).astype(int)
+    y0 = np.ceil((srtm_y0 - lat_ma) / srtm_dy).astype(int)
+    y1 = np.ceil((srtm_y0 - lat_mi) / srtm_dy).astype(int)
+
+    return [['{:02d}_{:02d}'.format(zx, zy)
+             for zx in range(a, b + 1) for zy in range(c, d + 1)]
+            for a, b, c, d in zip(x0, x1, y0, y1)]
+
+
+class BBoxIndex(object):
+    """A grid index of named (lon_min, lon_max, lat_min, lat_max) boxes.
+
+    Each box is registered in the cells of a regular lon/lat grid it
+    intersects. A box containing an extent also contains its south-west
+    corner, so that only the boxes of one cell need to be checked: the
+    cost of a lookup does not grow with the number of boxes.
+
+    Parameters
+    ----------
+    boxes: dict
+        {name: [lon_min, lon_max, lat_min, lat_max]}. If several boxes
+        contain an extent, the first one (in this order) is returned.
+    cell_size: float
+        The size of the grid cells, in degrees.
+    """
+
+    def __init__(self, boxes=None, cell_size=10.):
+        self.cell_size = cell_size
+        self._cells = dict()
+        if boxes is not None:
+            for name, bbox in boxes.items():
+                self.insert(name, bbox)
+
+    def _cell(self, v):
+        return np.floor(np.asarray(v) / self.cell_size).astype(int)
+
+    def insert(self, name, bbox):
+        """Adds a box to the index (it has the lowest priority)."""
+        x0, x1, y0, y1 = [float(b) for b in bbox]
+        for i in range(self._cell(x0), self._cell(x1) + 1):
+            for j in range(self._cell(y0), self._cell(y1) + 1):
+                self._cells.setdefault((i, j), []).append((name, x0, x1,
+                                                            y0, y1))
+
+    def containing(self, lon_mi, lon_ma, lat_mi, lat_ma):
+        """Finds the boxes containing each of the extents.
+
+        Parameters
+        ----------
+        lon_mi, lon_ma, lat_mi, lat_ma: array-like
+            The bounds of N extents.
+
+        Returns
+        -------
+        A list of N names (None where no box contains the extent).
+        """
+
+        lon_mi, lon_ma, lat_mi, lat_ma = [np.atleast_1d(v) for v in
+                                          [lon_mi, lon_ma, lat_mi, lat_ma]]
+        out = [None] * len(lon_mi)
+        ci = self._cell(lon_mi)
+        cj = self._cell(lat_mi)
+        for i, j in set(zip(ci, cj)):
+            boxes = self._cells.get((i, j))
+            if not boxes:
+                continue
+            todo = (ci == i) & (cj == j)
+            for name, x0, x1, y0, y1 in boxes:
+                ok = todo & (lon_mi >= x0) & (lon_ma <= x1) & \
+                     (lat_mi >= y0) & (lat_ma <= y1)
+                for k in np.nonzero(ok)[0]:
+                    out[k] = name
+                todo &= ~ok
+        return out
+
+
+_bbox_indexes = dict()
+
+
+def _get_bbox_index(boxes):
+    """The (cached) BBoxIndex of a dict of boxes."""
+    key = tuple((k, tuple(v)) for k, v in boxes.items())
+    if key not in _bbox_indexes:
+        _bbox_indexes[key] = BBoxIndex(boxes)
+    return _bbox_indexes[key]
 
 
 def dem3_viewpano_zone(lon_ran, lat_ran, extra_reg=DEM3REG):
@@ -558,71 +1614,68 @@ def dem3_viewpano_zone(lon_ran, lat_ran, extra_reg=DEM3REG):
     -------
     A list of viewfinderpanorama zones covering the latitude/longitude range.
     """
+    return dem3_viewpano_zones(lon_ran, lat_ran, extra_reg=extra_reg)[0]
 
-    for _f in extra_reg.keys():
-
-        if (np.min(lon_ran) >= extra_reg[_f][0]) and \
-           (np.max(lon_ran) <= extra_reg[_f][1]) and \
-           (np.min(lat_ran) >= extra_reg[_f][2]) and \
-           (np.max(lat_ran) <= extra_reg[_f][3]):
-
-            # test some weird inset files in Antarctica
-            if (np.min(lon_ran) >= -91.) and (np.max(lon_ran) <= -90.) and \
-               (np.min(lat_ran) >= -72.) and (np.max(lat_ran) <= -68.):
-                return ['SR15']
-
-            elif (np.min(lon_ran) >= -47.) and (np.max(lon_ran) <= -43.) and \
-                 (np.min(lat_ran) >= -61.) and (np.max(lat_ran) <= -60.):
-                return ['SP23']
 
-            elif (np.min(lon_ran) >= 162.) and (np.max(lon_ran) <= 165.) and \
-                 (np.min(lat_ran) >= -68.) and (np.max(lat_ran) <= -66.):
-                return ['SQ58']
-
-            # test some Greenland tiles as GL-North is not rectangular
-            elif (np.min(lon_ran) >= -66.) and (np.max(lon_ran) <= -60.) and \
-                 (np.min(lat_ran) >= 80.) and (np.max(lat_ran) <= 83.):
-                return ['U20']
-
-            elif (np.min(lon_ran) >= -60.) and (np.max(lon_ran) <= -54.) and \
-                 (np.min(lat_ran) >= 80.) and (np.max(lat_ran) <= 83.):
-                return ['U21']
+def dem3_viewpano_zones(lon_ex, lat_ex, extra_reg=DEM3REG):
+    """
+    Returns the DEM3 zones of many extents at once.
 
-            elif (np.min(lon_ran) >= -54.) and (np.max(lon_ran) <= -48.) and \
-                 (np.min(lat_ran) >= 80.) and (np.max(lat_ran) <= 83.):
-                return ['U22']
+    Parameters
+    ----------
+    lon_ex: array-like
+        (N, 2) array of (min_lon, max_lon) longitude ranges
+    lat_ex: array-like
+        (N, 2) array of (min_lat, max_lat) latitude ranges
+    extra_reg: dict
+        A dictionary of the extra regions not following the scheme.
+        The tiles of DEM3INSETS lying within them take precedence.
 
-            else:
-                return [_f]
+    Returns
+    -------
+    A list of N sorted lists of viewfinderpanorama zones, one for each extent.
+    """
 
     # If the tile doesn't have a special name, its name can be found like this:
     # corrected SRTMs are sorted in tiles of 6 deg longitude and 4 deg latitude
+    # Columns are counted from -180 (a point on an edge is in the west tile),
+    # rows are lettered from the equator, northwards and southwards
     srtm_x0 = -180.
-    srtm_y0 = 0.
     srtm_dx = 6.
     srtm_dy = 4.
 
-    # quick n dirty solution to be sure that we will cover the whole range
-    mi, ma = np.min(lon_ran), np.max(lon_ran)
-    # TODO: Fabien, find out what Johannes wanted with this +3
-    # +3 is just for the number to become still a bit larger
-    lon_ex = np.linspace(mi, ma, int(np.ceil((ma - mi)/srtm_dy)+3))
-    mi, ma = np.min(lat_ran), np.max(lat_ran)
-    lat_ex = np.linspace(mi, ma, int(np.ceil((ma - mi)/srtm_dx)+3))
-
-    zones = []
-    for lon in lon_ex:
-        for lat in lat_ex:
-            dx = lon - srtm_x0
-            dy = lat - srtm_y0
-            zx = np.ceil(dx / srtm_dx)
-            # convert number to letter
-            zy = chr(int(abs(dy / srtm_dy)) + ord('A'))
-            if lat >= 0:
-                zones.append('%s%02.0f' % (zy, zx))
-            else:
-                zones.append('S%s%02.0f' % (zy, zx))
-    return list(sorted(set(zones)))
+    lon_mi, lon_ma, lat_mi, lat_ma = _extent_ranges(lon_ex, lat_ex)
+
+    x0 = np.clip(np.ceil((lon_mi - srtm_x0) / srtm_dx), 1, 60).astype(int)
+    x1 = np.clip(np.ceil((lon_ma - srtm_x0) / srtm_dx), 1, 60).astype(int)
+    # northern rows (if any)
+    n0 = np.floor(np.clip(lat_mi, 0, None) / srtm_dy).astype(int)
+    n1 = np.floor(lat_ma / srtm_dy).astype(int)
+    # southern rows (if any)
+    s0 = np.floor(np.clip(-lat_ma, 0, None) / srtm_dy).astype(int)
+    s1 = np.floor(-lat_mi / srtm_dy).astype(int)
+
+    # special regions, and the inset files within them
+    special = _get_bbox_index(extra_reg).containing(lon_mi, lon_ma,
+                                                    lat_mi, lat_ma)
+    insets = _get_bbox_index(DEM3INSETS).containing(lon_mi, lon_ma,
+                                                    lat_mi, lat_ma)
+
+    out = []
+    for i in range(len(lon_mi)):
+        if special[i] is not None:
+            out.append([insets[i] or special[i]])
+            continue
+        zones = []
+        for zx in range(x0[i], x1[i] + 1):
+            if lat_ma[i] >= 0:
+                zones.extend(['%s%02d' % (chr(zy + ord('A')), zx)
+                              for zy in range(n0[i], n1[i] + 1)])
+            if lat_mi[i] < 0:
+                zones.extend(['S%s%02d' % (chr(zy + ord('A')), zx)
+                              for zy in range(s0[i], s1[i] + 1)])
+        out.append(sorted(zones))
+    return out
 
 
 def aster_zone(lon_ran, lat_ran):
@@ -641,46 +1694,124 @@ def aster_zone(lon_ran, lat_ran):
     (zones, units): A list of zones and a list of units covering the latitude 
     and longitude range
     """
+    return aster_zones(lon_ran, lat_ran)[0]
+
+
+def aster_zones(lon_ex, lat_ex):
+    """
+    Returns the ASTER V2 zones and units of many extents at once.
+
+    Parameters
+    ----------
+    lon_ex: array-like
+        (N, 2) array of (min_lon, max_lon) longitude ranges
+    lat_ex: array-like
+        (N, 2) array of (min_lat, max_lat) latitude ranges
+
+    Returns
+    -------
+    A list of N (zones, units) tuples, one for each extent.
+    """
 
     # ASTER is a bit more work. The units are directories of 5 by 5,
     # tiles are 1 by 1. The letter in the filename depends on the sign
-    units_dx = 5.
-
-    # quick n dirty solution to be sure that we will cover the whole range
-    mi, ma = np.min(lon_ran), np.max(lon_ran)
-    lon_ran = np.linspace(mi, ma, int(np.ceil((ma - mi) + 3)))
-    mi, ma = np.min(lat_ran), np.max(lat_ran)
-    lat_ran = np.linspace(mi, ma, int(np.ceil((ma - mi) + 3)))
-
-    zones = []
-    units = []
-    for lon in lon_ran:
-        for lat in lat_ran:
-            dx = np.floor(lon)
-            zx = np.floor(lon / units_dx) * units_dx
-            if math.copysign(1, dx) == -1:
-                dx = -dx
-                zx = -zx
-                lon_let = 'W'
-            else:
-                lon_let = 'E'
-
-            dy = np.floor(lat)
-            zy = np.floor(lat / units_dx) * units_dx
-            if math.copysign(1, dy) == -1:
-                dy = -dy
-                zy = -zy
-                lat_let = 'S'
-            else:
-                lat_let = 'N'
+    units_dx = 5
+
+    lon_mi, lon_ma, lat_mi, lat_ma = _extent_ranges(lon_ex, lat_ex)
+    x0 = np.floor(lon_mi).astype(int)
+    x1 = np.floor(lon_ma).astype(int)
+    y0 = np.floor(lat_mi).astype(int)
+    y1 = np.floor(lat_ma).astype(int)
+
+    def _name(v, pos, neg, fmt):
+        return (neg if v < 0 else pos) + fmt.format(abs(v))
+
+    out = []
+    for a, b, c, d in zip(x0, x1, y0, y1):
+        zones = []
+        units = []
+        for dx in range(a, b + 1):
+            zx = dx // units_dx * units_dx
+            for dy in range(c, d + 1):
+                zy = dy // units_dx * units_dx
+                zones.append(_name(dy, 'N', 'S', '{:02d}') +
+                             _name(dx, 'E', 'W', '{:03d}'))
+                units.append(_name(zy, 'N', 'S', '{:02d}') +
+                             _name(zx, 'E', 'W', '{:03d}'))
+        out.append((zones, units))
+    return out
+
+
+def zone_bbox(zone, source):
+    """
+    Returns the (lon_min, lon_max, lat_min, lat_max) box of a tile.
+
+    Parameters
+    ----------
+    zone: str
+        A zone of srtm_zone, dem3_viewpano_zone or aster_zone.
+    source: str
+        'SRTM', 'DEM3' or 'ASTER'.
+    """
 
-            z = '{}{:02.0f}{}{:03.0f}'.format(lat_let, dy, lon_let, dx)
-            u = '{}{:02.0f}{}{:03.0f}'.format(lat_let, zy, lon_let, zx)
-            if z not in zones:
-                zones.append(z)
-                units.append(u)
+    if source == 'SRTM':
+        zx, zy = [int(z) for z in zone.split('_')]
+        x0 = -180. + 5 * (zx - 1)
+        y1 = 60. - 5 * (zy - 1)
+        return [x0, x0 + 5, y1 - 5, y1]
+    if source == 'DEM3':
+        for reg in [DEM3INSETS, DEM3REG]:
+            if zone in reg:
+                return list(reg[zone])
+        south = zone.startswith('S') and len(zone) == 4
+        zy = ord(zone[-3]) - ord('A')
+        x0 = -180. + 6 * (int(zone[-2:]) - 1)
+        if south:
+            return [x0, x0 + 6, -4. * (zy + 1), -4. * zy]
+        return [x0, x0 + 6, 4. * zy, 4. * (zy + 1)]
+    if source == 'ASTER':
+        y0 = int(zone[1:3]) * (-1 if zone[0] == 'S' else 1)
+        x0 = int(zone[4:7]) * (-1 if zone[3] == 'W' else 1)
+        return [x0, x0 + 1, y0, y0 + 1]
+    raise ValueError('DEM source {} not available.'.format(source))
+
+
+def geometry_zones(geometry, source):
+    """
+    Returns the tiles of a DEM source intersecting a geometry.
 
-    return zones, units
+    Unlike the zones of the bounding box of the geometry, the tiles which
+    are not crossed by it (e.g. for long, diagonal or multi-part glacier
+    outlines) are left out.
+
+    Parameters
+    ----------
+    geometry: shapely geometry
+        In longitude/latitude coordinates.
+    source: str
+        'SRTM', 'DEM3' or 'ASTER'.
+
+    Returns
+    -------
+    A sorted list of zones (for ASTER, of (zone, unit) tuples).
+    """
+
+    lon_mi, lat_mi, lon_ma, lat_ma = geometry.bounds
+    lon_ex, lat_ex = [lon_mi, lon_ma], [lat_mi, lat_ma]
+    if source == 'SRTM':
+        zones = srtm_zone(lon_ex, lat_ex)
+    elif source == 'DEM3':
+        zones = dem3_viewpano_zone(lon_ex, lat_ex)
+    elif source == 'ASTER':
+        zones = list(zip(*aster_zone(lon_ex, lat_ex)))
+    else:
+        raise ValueError('DEM source {} not available.'.format(source))
+
+    def _box(z):
+        x0, x1, y0, y1 = zone_bbox(z[0] if source == 'ASTER' else z,
+                                   source)
+        return shpg.box(x0, y0, x1, y1)
+    return sorted(z for z in zones if _box(z).intersects(geometry))
 
 
 def get_sample_file(repo, fname, outdir):
@@ -708,10 +1839,14 @@ def get_sample_file(repo, fname, outdir):
         return None
 
 
-def get_rgi_data(outdir, version='5.0'):
+def get_rgi_data(outdir, version='5.0', regions=None):
     """
     Checks if the given version of the Randolph Glacier Inventory (RGI) is in 
     the given directory. If not, downloads it.
+
+    The archive of each region is extracted from the RGI archive when it is
+    first asked for, in a folder of its own name (e.g.
+    ``outdir/01_rgi50_Alaska``).
     
     Parameters
     ----------
@@ -719,20 +1854,39 @@ def get_rgi_data(outdir, version='5.0'):
         Directory where to download the RGI to, if not already present.
     version: str
         Version of RGI to be downloaded.
+    regions: list of int, optional
+        The RGI regions needed (e.g. [11]): only the archives of these ones
+        are extracted. The default is to extract all of them.
 
     Returns
     -------
     Directory where the RGI is stored.
     """
-    with get_download_lock(outdir):
-        return _get_rgi_data_unlocked(outdir, version)
+
+    # files are written atomically: no need to lock if already there
+    bname = 'rgi{}.zip'.format(version.replace('.', ''))
+    ofile = os.path.join(outdir, bname)
+    if not os.path.exists(ofile):
+        with get_file_lock(ofile):
+            _get_rgi_data_unlocked(outdir, version)
+
+    for member in _rgi_region_members(ofile, version, regions=regions):
+        # the folders appear once complete: no need to lock if already there
+        odir = os.path.join(outdir, os.path.splitext(member)[0])
+        if os.path.exists(odir):
+            continue
+        with get_file_lock(odir):
+            if not os.path.exists(odir):
+                _extract_rgi_region(ofile, member, odir)
+    return outdir
 
 
 def _get_rgi_data_unlocked(rgi_dir, version):
     """
     Returns a path to the RGI directory.
 
-    If the files are not present, download them.
+    If the RGI archive is not present, download it, and extract the files
+    which are not region archives (see get_rgi_data).
 
     Returns
     -------
@@ -751,28 +1905,68 @@ def _get_rgi_data_unlocked(rgi_dir, version):
     if not os.path.exists(ofile):  # pragma: no cover
         tf = 'http://www.glims.org/RGI/rgi{}_files/'.format(version_fn) + bname
         try:
-            progress_urlretrieve(tf, ofile)
+            progress_urlretrieve(tf, ofile + '.tmp')
         except HTTPError:
             raise ValueError('Check if the given RGI version {} exists.'
                              .format(version))
 
-        # Extract root
-        with zipfile.ZipFile(ofile) as zf:
-            zf.extractall(rgi_dir)
-
-        # Extract subdirs
-        pattern = '*_rgi{}_*.zip'.format(version_fn)
-        for root, dirs, files in os.walk(rgi_dir):
-            for filename in fnmatch.filter(files, pattern):
-                ofile = os.path.join(root, filename)
-                with zipfile.ZipFile(ofile) as zf:
-                    ex_root = ofile.replace('.zip', '')
-                    mkdir(ex_root)
-                    zf.extractall(ex_root)
+        # Extract the root files, not the region archives
+        regions = _rgi_region_members(ofile + '.tmp', version)
+        with zipfile.ZipFile(ofile + '.tmp') as zf:
+            for member in zf.namelist():
+                if member not in regions and not member.endswith('/'):
+                    with _atomic_output(os.path.join(rgi_dir,
+                                                     member)) as tmp:
+                        mkdir(os.path.dirname(tmp))
+                        with zf.open(member) as fsrc, \
+                                open(tmp, 'wb') as fdst:
+                            shutil.copyfileobj(fsrc, fdst)
+        os.replace(ofile + '.tmp', ofile)
 
     return rgi_dir
 
 
+def _rgi_region_members(zfile, version, regions=None):
+    """The names of the region archives in the RGI archive `zfile`, for the
+    given regions (all by default). Raises a ValueError for unknown
+    regions."""
+
+    pattern = '*_rgi{}_*.zip'.format(version.replace('.', ''))
+    with zipfile.ZipFile(zfile) as zf:
+        names = [n for n in zf.namelist()
+                 if fnmatch.fnmatch(os.path.basename(n), pattern)]
+    if regions is None:
+        return sorted(names)
+
+    def _region(n):
+        reg = os.path.basename(n).split('_')[0]
+        return int(reg) if reg.isdigit() else None
+
+    regions = set(int(r) for r in regions)
+    names = [n for n in names if _region(n) in regions]
+    missing = regions.difference(_region(n) for n in names)
+    if missing:
+        raise ValueError('RGI regions {} not found in {}.'
+                         .format(sorted(missing), os.path.basename(zfile)))
+    return sorted(names)
+
+
+def _extract_rgi_region(zfile, member, odir):
+    """Extracts the region archive `member` of the RGI archive `zfile` in
+    the folder `odir`, which appears when complete."""
+
+    mkdir(os.path.dirname(odir))
+    tmpdir = tempfile.mkdtemp(prefix='.extract_', dir=os.path.dirname(odir))
+    try:
+        with zipfile.ZipFile(zfile) as zf:
+            subfile = zf.extract(member, tmpdir)
+        with zipfile.ZipFile(subfile) as zf:
+            zf.extractall(os.path.join(tmpdir, 'region'))
+        os.rename(os.path.join(tmpdir, 'region'), odir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def get_cru_file(outdir, var=None):
     """
     Returns a path to a Climate Research Unit Time Series (CRU TS) file.
@@ -791,7 +1985,15 @@ def get_cru_file(outdir, var=None):
     -------
     Path to the CRU TS file
     """
-    with get_download_lock(outdir):
+
+    # files are written atomically: no need to lock if already there
+    if var in ['tmp', 'pre']:
+        ofile = os.path.join(outdir,
+                             'cru_ts3.23.1901.2014.{}.dat.nc'.format(var))
+        if os.path.exists(ofile):
+            return ofile
+
+    with get_file_lock(os.path.join(outdir, 'cru_{}'.format(var))):
         return _get_cru_file_unlocked(outdir, var)
 
 
@@ -831,16 +2033,211 @@ def _get_cru_file_unlocked(cru_dir, var=None):
                      'cruts.1701201703.v3.24.01/'
         tf = cru_server + '{}/cru_ts3.24.01.1901.2015.{}.dat.gz'.format(var,
                                                                         var)
-        progress_urlretrieve(tf, ofile + '.gz')
-        with gzip.GzipFile(ofile + '.gz') as zf:
-            with open(ofile, 'wb') as outfile:
-                for line in zf:
-                    outfile.write(line)
+        if not os.path.exists(ofile + '.gz'):
+            progress_urlretrieve(tf, ofile, gunzip=True)
+            return ofile
+        # downloaded by an earlier version of geoget
+        print("Decompressing %s ..." % (ofile + '.gz'))
+        with _progress_bar() as hook, open(ofile + '.gz', 'rb') as zf:
+            with _atomic_output(ofile) as tmp:
+                with open(tmp, 'wb') as outfile:
+                    _gunzip(zf, outfile,
+                            total=os.path.getsize(ofile + '.gz'),
+                            reporthook=hook)
 
     return ofile
 
 
-def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
+def get_cru_chunked_file(outdir, var=None):
+    """
+    Returns a path to a CRU TS file converted for point and time series
+    reads.
+
+    The file of get_cru_file (downloaded if needed) is converted once to a
+    compressed NetCDF4 file, in chunks holding the whole time series of a
+    few grid cells (see CRU_CHUNKS): reading the series of a point or of a
+    small region only reads a few of them.
+
+    Parameters
+    ----------
+    outdir: str
+        Directory where to download the data if not already present.
+    var: str
+        'tmp' or 'pre' (see get_cru_file).
+
+    Returns
+    -------
+    Path to the converted CRU TS file.
+    """
+
+    # files are written atomically: no need to lock if already there
+    if var in ['tmp', 'pre']:
+        ofile = os.path.join(outdir,
+                             'cru_ts3.23.1901.2014.{}.chunked.nc'.format(var))
+        if os.path.exists(ofile):
+            return ofile
+
+    cru_file = get_cru_file(outdir, var=var)
+    with get_file_lock(os.path.join(outdir, 'cru_{}_chunked'.format(var))):
+        if not os.path.exists(ofile):
+            _rechunk_cru_file(cru_file, ofile)
+    return ofile
+
+
+def _rechunk_cru_file(cru_file, ofile):
+    """Copies a CRU TS file to a compressed NetCDF4 file in CRU_CHUNKS.
+
+    The gridded variables are copied by rows of chunks, so that only one
+    of them is in memory at a time.
+    """
+
+    with netCDF4.Dataset(cru_file) as src, _atomic_output(ofile) as tmp:
+        with netCDF4.Dataset(tmp, 'w', format='NETCDF4') as dst:
+            src.set_auto_maskandscale(False)
+            dst.set_auto_maskandscale(False)
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, None if dim.isunlimited()
+                                    else len(dim))
+            for name, v in src.variables.items():
+                dims = v.dimensions
+                chunks = None
+                if dims[-2:] == ('lat', 'lon'):
+                    chunks = [min(CRU_CHUNKS.get(d, len(src.dimensions[d])),
+                                  len(src.dimensions[d])) for d in dims]
+                out = dst.createVariable(
+                    name, v.dtype, dims, zlib=len(dims) > 0, shuffle=True,
+                    complevel=4, chunksizes=chunks,
+                    fill_value=getattr(v, '_FillValue', None))
+                out.setncatts({k: v.getncattr(k) for k in v.ncattrs()
+                               if k != '_FillValue'})
+                if chunks is None:
+                    out[...] = v[...]
+                    continue
+                for i in range(0, v.shape[-2], chunks[-2]):
+                    out[..., i:i + chunks[-2], :] = v[..., i:i + chunks[-2], :]
+
+
+def _cru_slice(coords, vmin, vmax):
+    """The slice of the CRU coordinates within [vmin, vmax], or of the
+    nearest one if none is."""
+
+    idx = np.nonzero((coords >= vmin) & (coords <= vmax))[0]
+    if len(idx) == 0:
+        idx = [np.argmin(np.abs(coords - (vmin + vmax) / 2))]
+    return slice(idx[0], idx[-1] + 1)
+
+
+def get_cru_subset(var, lon_ex, lat_ex, outdir, time_range=None):
+    """
+    Returns the CRU TS data of a small region.
+
+    Only the chunks of the region are read from the converted file of
+    get_cru_chunked_file (which is downloaded and converted if needed).
+
+    Parameters
+    ----------
+    var: str
+        'tmp' or 'pre' (see get_cru_file).
+    lon_ex : tuple
+        A (min_lon, max_lon) tuple delimitating the requested area
+        longitudes.
+    lat_ex : tuple
+        A (min_lat, max_lat) tuple delimitating the requested area
+        latitudes.
+    outdir: str
+        Directory where to store the CRU files.
+    time_range : tuple, optional
+        A (start, end) tuple of dates (e.g. ``('1961', '1990-12')``), both
+        included. The default is the whole time series.
+
+    Returns
+    -------
+    xarray.DataArray of the grid points within the extent, or of the
+    nearest one if there are none (e.g. for a point).
+    """
+
+    cru_file = get_cru_chunked_file(outdir, var=var)
+    with xr.open_dataset(cru_file) as ds:
+        da = ds[var].isel(lon=_cru_slice(ds.lon.values, np.min(lon_ex),
+                                         np.max(lon_ex)),
+                          lat=_cru_slice(ds.lat.values, np.min(lat_ex),
+                                         np.max(lat_ex)))
+        if time_range is not None:
+            da = da.sel(time=slice(*time_range))
+        return da.load()
+
+
+def _nearest_index(coords, values):
+    """The indices of the nearest (ascending) coordinates of values."""
+
+    i = np.clip(np.searchsorted(coords, values), 1, len(coords) - 1)
+    left, right = coords[i - 1], coords[i]
+    return np.where(values - left <= right - values, i - 1, i)
+
+
+def get_cru_points(lon, lat, outdir, variables=('tmp', 'pre'),
+                   time_range=None):
+    """
+    Returns the CRU TS series of the nearest grid points of many points.
+
+    The points are grouped by the chunk of their grid point in the files
+    of get_cru_chunked_file (downloaded and converted if needed): each
+    chunk holding some of them is read once, whatever their number.
+
+    Parameters
+    ----------
+    lon: array-like
+        The longitudes of the N points (e.g. glaciers).
+    lat: array-like
+        Their latitudes.
+    outdir: str
+        Directory where to store the CRU files.
+    variables: list of str, optional
+        The CRU variables to read ('tmp' and 'pre' by default).
+    time_range : tuple, optional
+        A (start, end) tuple of dates, both included (see get_cru_subset).
+
+    Returns
+    -------
+    xarray.Dataset with a (point, time) variable for each of `variables`,
+    and the coordinates of the grid point of each point (lon, lat).
+    """
+
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    if lon.shape != lat.shape:
+        raise ValueError('lon and lat must have the same length')
+
+    out = dict()
+    coords = None
+    for var in variables:
+        cru_file = get_cru_chunked_file(outdir, var=var)
+        with xr.open_dataset(cru_file) as ds:
+            if time_range is not None:
+                ds = ds.sel(time=slice(*time_range))
+            ix = _nearest_index(ds.lon.values, lon)
+            iy = _nearest_index(ds.lat.values, lat)
+            coords = dict(time=ds.time.values,
+                          lon=('point', ds.lon.values[ix]),
+                          lat=('point', ds.lat.values[iy]))
+            da = ds[var]
+            data = np.empty((len(lon), da.sizes['time']), dtype=da.dtype)
+            ny, nx = CRU_CHUNKS['lat'], CRU_CHUNKS['lon']
+            cy, cx = iy // ny, ix // nx
+            for ky, kx in sorted(set(zip(cy, cx))):
+                sel = (cy == ky) & (cx == kx)
+                block = da.isel(lat=slice(ky * ny, (ky + 1) * ny),
+                                lon=slice(kx * nx, (kx + 1) * nx)).values
+                data[sel] = block[:, iy[sel] - ky * ny, ix[sel] - kx * nx].T
+            out[var] = (('point', 'time'), data, da.attrs)
+    return xr.Dataset(out, coords=coords)
+
+
+def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None,
+                  max_workers=None, crop_buffer=None, output_format='GTiff',
+                  max_memory=None, output_profile=None, storage='extract',
+                  cache_budget=None, missing_expiry=None):
     """
     Returns a path to a Digital Elevation Model (DEM) file covering the 
     desired extent.
@@ -873,6 +2270,43 @@ def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
           - 'DEM3' : http://viewfinderpanoramas.org/
           - 'ASTER' : ASTER data
           - 'ETOPO1' : last resort, a very coarse global dataset
+    max_workers : int, optional
+        Number of tiles to download and extract at the same time. The
+        default is to fetch them one after the other.
+    crop_buffer : float, optional
+        If set, the merged DEM of a multi-tile request covers only the
+        extent plus this buffer (in degrees) instead of all tiles: only
+        these windows of the tiles are read.
+    output_format : str, optional
+        The format of merged DEMs: 'GTiff' (default) copies the pixels in a
+        new GeoTIFF, 'VRT' writes a light GDAL virtual mosaic referencing
+        the tiles instead.
+    max_memory : int, optional
+        If set, the GeoTIFF merges (including the assembly of the large DEM3
+        regions) are written block by block in a tiled GeoTIFF, using about
+        this many bytes of memory. The default is to merge in memory.
+    output_profile : str or dict, optional
+        The layout of the GeoTIFFs written by geoget (merged DEMs and DEM3
+        regions). The default is a plain GeoTIFF with the profile of the
+        tiles. 'COG' writes Cloud Optimized GeoTIFFs: tiled, compressed,
+        with internal overviews (see COG_PROFILE). A dict of creation
+        options updates COG_PROFILE (e.g. ``{'compress': 'lzw'}``). Files
+        written earlier with another profile are not converted.
+    storage : str, optional
+        How the downloaded tiles are stored: 'extract' (default) extracts
+        them from their archive, 'zip' keeps only the archives and reads the
+        tiles from them through GDAL's ``/vsizip/`` paths (see
+        download_srtm_file). A single tile DEM is then such a path.
+    cache_budget : int, optional
+        The merged DEMs of outdir are recorded in a cache index with their
+        size when they are written. If set, their time of last use is also
+        recorded at each call, and the least recently used ones are removed
+        so that they use at most this many bytes (see trim_cache). The
+        downloaded tiles are never removed.
+    missing_expiry : float, optional
+        Tiles not found on the server (oceans) are remembered in
+        ``outdir/missing_tiles.json``. After this number of seconds the
+        server is asked again. The default is to never ask again.
 
     Returns
     -------
@@ -885,11 +2319,262 @@ def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
         for s in source:
             demf, source_str = get_topo_file(lon_ex, lat_ex, outdir,
                                              rgi_region=rgi_region,
-                                             source=s)
-            if os.path.isfile(demf):
+                                             source=s,
+                                             max_workers=max_workers,
+                                             crop_buffer=crop_buffer,
+                                             output_format=output_format,
+                                             max_memory=max_memory,
+                                             output_profile=output_profile,
+                                             storage=storage,
+                                             cache_budget=cache_budget,
+                                             missing_expiry=missing_expiry)
+            if rasterio.shutil.exists(demf):
                 return demf, source_str
+        raise RuntimeError('No topography file available!')
+
+    # If not, do the job ourselves: download and merge stuff
+    source = _topo_source(lon_ex, lat_ex, rgi_region=rgi_region,
+                          source=source)
+
+    # For the very last cases a very coarse dataset ?
+    if source == 'ETOPO1':
+        return _etopo1_file(outdir), 'ETOPO1'
+
+    zones, download_func = _topo_zones(lon_ex, lat_ex, source,
+                                       max_memory=max_memory,
+                                       output_profile=output_profile,
+                                       storage=storage,
+                                       missing_expiry=missing_expiry)
+    sources = _download_zones(download_func, zones, outdir,
+                              max_workers=max_workers)
+    return _merged_topo_file(sources, zones, source, outdir,
+                             bounds=_crop_bounds(lon_ex, lat_ex, crop_buffer),
+                             output_format=output_format,
+                             max_memory=max_memory,
+                             output_profile=output_profile,
+                             cache_budget=cache_budget)
+
+
+def get_topo_files(lon_ex, lat_ex, outdir, rgi_region=None, source=None,
+                   max_workers=None, crop_buffer=None, output_format='GTiff',
+                   max_memory=None, output_profile=None,
+                   storage='extract', cache_budget=None,
+                   missing_expiry=None):
+    """
+    Returns the DEM files of many extents at once.
+
+    Same as calling get_topo_file for each extent, but the tiles needed by
+    all extents are computed in one go, and each of them is checked and
+    downloaded only once (concurrently with `max_workers`) before the merge
+    of each extent.
+
+    Parameters
+    ----------
+    lon_ex : array-like, required
+        (N, 2) array of (min_lon, max_lon) longitude ranges.
+    lat_ex : array-like, required
+        (N, 2) array of (min_lat, max_lat) latitude ranges.
+    outdir : str, required
+        Directory where to store the DEM files.
+    rgi_region : int or array-like of int, optional
+        The RGI region number, for all extents or one per extent.
+    source : str, optional
+        To force the use of a certain DEM source (see get_topo_file). Lists
+        of sources are not supported here.
+    max_workers : int, optional
+        Number of tiles to download (and extents to merge) at the same time.
+    crop_buffer : float, optional
+        Crop the merged DEMs to the extent plus this buffer (see
+        get_topo_file).
+    output_format : str, optional
+        'GTiff' or 'VRT' (see get_topo_file).
+    max_memory : int, optional
+        Memory budget of the merges (see get_topo_file).
+    output_profile : str or dict, optional
+        Layout of the written GeoTIFFs (see get_topo_file).
+    storage : str, optional
+        Storage of the downloaded tiles (see get_topo_file).
+    cache_budget : int, optional
+        Disk budget of the merged DEMs (see get_topo_file).
+    missing_expiry : float, optional
+        Expiry of the missing tiles (see get_topo_file).
+
+    Returns
+    -------
+    list of N (path to the DEM file, data source) tuples.
+    """
+
+    if source is not None and not isinstance(source, string_types):
+        raise ValueError('get_topo_files needs a single DEM source.')
+
+    lon_mi, lon_ma, lat_mi, lat_ma = _extent_ranges(lon_ex, lat_ex)
+    lon_ex = np.stack([lon_mi, lon_ma], axis=1)
+    lat_ex = np.stack([lat_mi, lat_ma], axis=1)
+    n = len(lon_ex)
+    if rgi_region is None or np.isscalar(rgi_region):
+        rgi_region = [rgi_region] * n
+
+    sources = [_topo_source(lon, lat, rgi_region=reg, source=source)
+               for lon, lat, reg in zip(lon_ex, lat_ex, rgi_region)]
+
+    # the zones of each extent, and the union of them for each source
+    zones = [None] * n
+    paths = dict()
+    for src in sorted(set(sources)):
+        if src == 'ETOPO1':
+            continue
+        idx = [i for i, s in enumerate(sources) if s == src]
+        src_zones, download_func = _topo_zones_batch(
+            lon_ex[idx], lat_ex[idx], src, max_memory=max_memory,
+            output_profile=output_profile, storage=storage,
+            missing_expiry=missing_expiry)
+        for i, z in zip(idx, src_zones):
+            zones[i] = z
+        needed = sorted(set(z for zs in src_zones for z in zs))
+        files = _download_zones(download_func, needed, outdir,
+                                max_workers=max_workers)
+        paths[src] = dict(zip(needed, files))
+
+    def _merge(i):
+        if sources[i] == 'ETOPO1':
+            return _etopo1_file(outdir), 'ETOPO1'
+        files = [paths[sources[i]][z] for z in zones[i]]
+        bounds = _crop_bounds(lon_ex[i], lat_ex[i], crop_buffer)
+        return _merged_topo_file(files, zones[i], sources[i], outdir,
+                                 bounds=bounds, output_format=output_format,
+                                 max_memory=max_memory,
+                                 output_profile=output_profile,
+                                 cache_budget=cache_budget)
+
+    if max_workers is None or max_workers <= 1:
+        return [_merge(i) for i in range(n)]
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(_merge, range(n)))
+
+
+def get_topo_array(lon_ex, lat_ex, outdir, rgi_region=None, source=None,
+                   max_workers=None, crop_buffer=None, storage='extract',
+                   missing_expiry=None, out=None):
+    """
+    Returns the DEM of an extent as an array, without writing a merged file.
+
+    The tiles are downloaded (or taken from the cache) like in
+    get_topo_file, but their windows are read straight into the output
+    array: the result is the same as reading the merged DEM file.
+
+    Parameters
+    ----------
+    lon_ex, lat_ex, outdir, rgi_region, max_workers, crop_buffer, storage,
+    missing_expiry : see get_topo_file.
+    source : str, optional
+        To force the use of a certain DEM source (see get_topo_file). Lists
+        of sources are not supported here.
+    out : ndarray, optional
+        Where to write the DEM, of shape (bands, rows, columns). By default
+        a new array is allocated.
+
+    Returns
+    -------
+    tuple: (DEM array, its affine transform, data source).
+    """
+
+    if source is not None and not isinstance(source, string_types):
+        raise ValueError('get_topo_array needs a single DEM source.')
+
+    source = _topo_source(lon_ex, lat_ex, rgi_region=rgi_region,
+                          source=source)
+    if source == 'ETOPO1':
+        sources = [_etopo1_file(outdir)]
+    else:
+        zones, download_func = _topo_zones(lon_ex, lat_ex, source,
+                                           storage=storage,
+                                           missing_expiry=missing_expiry)
+        sources = _download_zones(download_func, zones, outdir,
+                                  max_workers=max_workers)
+        sources = [s for s in sources if s is not None]
+    if len(sources) < 1:
+        raise RuntimeError('No topography file available!')
+
+    dem, transform = _read_mosaic(sources,
+                                  bounds=_crop_bounds(lon_ex, lat_ex,
+                                                      crop_buffer),
+                                  out=out)
+    return dem, transform, source
+
+
+def get_topo_file_from_geometry(geometry, outdir, buffer=0., rgi_region=None,
+                                source=None, max_workers=None,
+                                crop_buffer=None, output_format='GTiff',
+                                max_memory=None, output_profile=None,
+                                storage='extract', cache_budget=None,
+                                missing_expiry=None):
+    """
+    Returns a path to a DEM file covering a geometry (e.g. a glacier).
+
+    Same as get_topo_file for the bounding box of the buffered geometry,
+    but only the tiles the buffered geometry intersects are downloaded and
+    merged (see geometry_zones). The other tiles of the box are nodata.
+
+    Parameters
+    ----------
+    geometry : shapely geometry or GeoDataFrame row
+        The outline, in longitude/latitude coordinates. For a row (e.g. of
+        an RGI file), the RGI region is read from its 'O1Region' entry if
+        not given.
+    outdir : str, required
+        Directory where to store the DEM files.
+    buffer : float, optional
+        Buffer around the geometry (in degrees) for the choice of the tiles.
+    rgi_region, source : see get_topo_file (lists of sources are not
+        supported here).
+    crop_buffer : float, optional
+        If set, the DEM is cropped to the bounding box of the buffered
+        geometry plus this buffer (see get_topo_file).
+    max_workers, output_format, max_memory, output_profile, storage,
+    cache_budget, missing_expiry : see get_topo_file.
+
+    Returns
+    -------
+    tuple: (path to the DEM file, data source).
+    """
+
+    if hasattr(geometry, 'geometry'):
+        if rgi_region is None:
+            rgi_region = geometry.get('O1Region', None)
+        geometry = geometry.geometry
+    if source is not None and not isinstance(source, string_types):
+        raise ValueError('get_topo_file_from_geometry needs a single DEM '
+                         'source.')
+
+    if buffer:
+        geometry = geometry.buffer(buffer)
+    lon_mi, lat_mi, lon_ma, lat_ma = geometry.bounds
+    lon_ex, lat_ex = [lon_mi, lon_ma], [lat_mi, lat_ma]
+
+    source = _topo_source(lon_ex, lat_ex, rgi_region=rgi_region,
+                          source=source)
+    if source == 'ETOPO1':
+        return _etopo1_file(outdir), 'ETOPO1'
+
+    _, download_func = _topo_zones(lon_ex, lat_ex, source,
+                                   max_memory=max_memory,
+                                   output_profile=output_profile,
+                                   storage=storage,
+                                   missing_expiry=missing_expiry)
+    zones = geometry_zones(geometry, source)
+    sources = _download_zones(download_func, zones, outdir,
+                              max_workers=max_workers)
+    return _merged_topo_file(sources, zones, source, outdir,
+                             bounds=_crop_bounds(lon_ex, lat_ex, crop_buffer),
+                             output_format=output_format,
+                             max_memory=max_memory,
+                             output_profile=output_profile,
+                             cache_budget=cache_budget)
+
+
+def _topo_source(lon_ex, lat_ex, rgi_region=None, source=None):
+    """Chooses the DEM source of an extent (see get_topo_file)."""
 
-    # If not, do the job ourselves: download and merge stuff:
     # GIMP is in polar stereographic, not easy to test if glacier is on the map
     # It would be possible with a salem grid but this is a bit more expensive
     # Instead, we are just asking RGI for the region
@@ -897,9 +2582,6 @@ def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
         source = 'GIMP' if source is None else source
         if source == 'GIMP':
             raise NotImplementedError('GIMP DEM download under development.')
-            gimp_file = _download_alternate_topo_file(outdir,
-                                                      'gimpdem_90m.tif')
-            return gimp_file, source
 
     # Same for Antarctica
     if source == 'RAMP' or (rgi_region is not None and int(rgi_region) == 19):
@@ -910,48 +2592,84 @@ def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
             source = 'RAMP' if source is None else source
         if source == 'RAMP':
             raise NotImplementedError('RAMP DEM download under development.')
-            gimp_file = _download_alternate_topo_file(outdir,
-                                                      'AntarcticDEM_wgs84.tif')
-            return gimp_file, source
 
     # Anywhere else on Earth we check for DEM3, ASTER, or SRTM
     if (np.min(lat_ex) < -60.) or (np.max(lat_ex) > 60.) \
             or source == 'DEM3' or source == 'ASTER':
         # default is DEM3
         source = 'DEM3' if source is None else source
-        if source == 'DEM3':
-            # use corrected viewpanoramas.org DEM
-            zones = dem3_viewpano_zone(lon_ex, lat_ex)
-            sources = []
-            for z in zones:
-                sources.append(download_dem3_viewpano(z, outdir))
-            source_str = source
-        if source == 'ASTER':
-            raise NotImplementedError('ASTER DEM download under development.')
-            # use ASTER
-            zones, units = aster_zone(lon_ex, lat_ex)
-            sources = []
-            for z, u in zip(zones, units):
-                sf = _download_aster_file(outdir, z, u)
-                if sf is not None:
-                    sources.append(sf)
-            source_str = source
     else:
         source = 'SRTM' if source is None else source
-        if source == 'SRTM':
-            zones = srtm_zone(lon_ex, lat_ex)
-            sources = []
-            for z in zones:
-                sources.append(download_srtm_file(z, outdir))
-            source_str = source
+    return source
+
+
+def _topo_zones(lon_ex, lat_ex, source, max_memory=None,
+                output_profile=None, storage='extract', missing_expiry=None):
+    """Returns the zones of a DEM source covering an extent, together with
+    the function downloading a zone."""
+
+    zones, download_func = _topo_zones_batch(lon_ex, lat_ex, source,
+                                             max_memory=max_memory,
+                                             output_profile=output_profile,
+                                             storage=storage,
+                                             missing_expiry=missing_expiry)
+    return zones[0], download_func
+
+
+def _topo_zones_batch(lon_ex, lat_ex, source, max_memory=None,
+                      output_profile=None, storage='extract',
+                      missing_expiry=None):
+    """Same as _topo_zones, but for (N, 2) arrays of extents."""
+
+    if source == 'DEM3':
+        # use corrected viewpanoramas.org DEM
+        download_func = functools.partial(download_dem3_viewpano,
+                                          max_memory=max_memory,
+                                          output_profile=output_profile,
+                                          storage=storage,
+                                          missing_expiry=missing_expiry)
+        return dem3_viewpano_zones(lon_ex, lat_ex), download_func
+    if source == 'SRTM':
+        download_func = functools.partial(download_srtm_file,
+                                          storage=storage,
+                                          missing_expiry=missing_expiry)
+        return srtm_zones(lon_ex, lat_ex), download_func
+    if source == 'ASTER':
+        raise NotImplementedError('ASTER DEM download under development.')
+    raise ValueError('DEM source {} not available.'.format(source))
+
+
+def _etopo1_file(outdir):
+    t_file = os.path.join(outdir, 'ETOPO1_Ice_g_geotiff.tif')
+    assert os.path.exists(t_file)
+    return t_file
+
+
+def _crop_bounds(lon_ex, lat_ex, buffer=None):
+    """The (left, bottom, right, top) bounds of a buffered extent, or None
+    if no buffer is given (no cropping)."""
+
+    if buffer is None:
+        return None
+    return (np.min(lon_ex) - buffer, np.min(lat_ex) - buffer,
+            np.max(lon_ex) + buffer, np.max(lat_ex) + buffer)
 
-    # For the very last cases a very coarse dataset ?
-    if source == 'ETOPO1':
-        t_file = os.path.join(outdir, 'ETOPO1_Ice_g_geotiff.tif')
-        assert os.path.exists(t_file)
-        return t_file, 'ETOPO1'
+
+def _merged_topo_file(sources, zones, source_str, outdir, bounds=None,
+                      output_format='GTiff', max_memory=None,
+                      output_profile=None, cache_budget=None):
+    """Returns the (path, source) of the DEM covering all tiles, merging
+    them if needed. If bounds are given, the merged DEM is cropped to
+    them. The merged DEMs are recorded in the cache index, which is trimmed
+    to the cache budget if given (see trim_cache)."""
+
+    if output_format not in ['GTiff', 'VRT']:
+        raise ValueError('Output format {} not available.'
+                         .format(output_format))
+    ext = '.vrt' if output_format == 'VRT' else '.tif'
 
     # filter for None (e.g. oceans)
+    zones_in = [z for z, s in zip(zones, sources) if s is not None]
     sources = [s for s in sources if s is not None]
 
     if len(sources) < 1:
@@ -962,34 +2680,491 @@ def get_topo_file(lon_ex, lat_ex, outdir, rgi_region=None, source=None):
     else:
         # merge
         zone_str = '+'.join(zones)
-        bname = source_str.lower() + '_merged_' + zone_str + '.tif'
+        if bounds is not None:
+            zone_str += '_' + '_'.join('{:.4f}'.format(b) for b in bounds)
+        bname = source_str.lower() + '_merged_' + zone_str + ext
 
         if len(bname) > 200:  # file name way too long
             import hashlib
             hash_object = hashlib.md5(bname.encode())
-            bname = hash_object.hexdigest() + '.tif'
+            bname = hash_object.hexdigest() + ext
 
         merged_file = os.path.join(outdir, source_str.lower(),
                                    bname)
+        # files are written atomically: no need to lock if already there
+        created = False
         if not os.path.exists(merged_file):
-            # check case where wrong zip file is downloaded from
-            if all(x is None for x in sources):
-                raise ValueError('Chosen lat/lon values are not available')
-            # write it
-            rfiles = [rasterio.open(s) for s in sources]
-            dest, output_transform = merge_tool(rfiles)
-            profile = rfiles[0].profile
-            if 'affine' in profile:
-                profile.pop('affine')
-            profile['transform'] = output_transform
-            profile['height'] = dest.shape[1]
-            profile['width'] = dest.shape[2]
-            profile['driver'] = 'GTiff'
-            with rasterio.open(merged_file, 'w', **profile) as dst:
-                dst.write(dest)
+            with get_file_lock(merged_file):
+                created = not os.path.exists(merged_file)
+                if created:
+                    refs = _write_merged_topo_file(
+                        sources, zones_in, merged_file, source_str, outdir,
+                        bounds=bounds, output_format=output_format,
+                        max_memory=max_memory, output_profile=output_profile)
+        # the (locked) cache index is only written for new files, or to
+        # keep track of their last use if a budget is given
+        if created:
+            with rasterio.open(merged_file) as ds:
+                _touch_product(outdir, merged_file, bounds=ds.bounds,
+                               refs=refs, zones=zones_in)
+        elif cache_budget is not None:
+            _touch_product(outdir, merged_file)
+        if cache_budget is not None:
+            trim_cache(outdir, cache_budget, keep=[merged_file])
         return merged_file, source_str + '_MERGED'
 
 
+def _write_merged_topo_file(sources, zones, merged_file, source_str, outdir,
+                            bounds=None, output_format='GTiff',
+                            max_memory=None, output_profile=None):
+    """Writes the merged DEM of the tiles `sources` of `zones` (see
+    _merged_topo_file).
+
+    If merged DEMs of the cache cover the output, it is cropped from them
+    instead of merging the tiles again. Returns the list of the merged DEMs
+    referenced by the output (VRT).
+    """
+
+    mosaics, target = _covering_products(sources, zones, source_str,
+                                         outdir, bounds=bounds)
+    if mosaics:
+        try:
+            if output_format == 'VRT':
+                _write_vrt(mosaics, merged_file, bounds=target)
+                return mosaics
+            _merge_topo_files(mosaics, merged_file, bounds=target,
+                              max_memory=max_memory,
+                              output_profile=output_profile)
+            return []
+        except OSError:
+            # removed from the cache in the meantime: use the tiles
+            pass
+
+    if output_format == 'VRT':
+        _write_vrt(sources, merged_file, bounds=bounds)
+    else:
+        _merge_topo_files(sources, merged_file, bounds=bounds,
+                          max_memory=max_memory,
+                          output_profile=output_profile)
+    return []
+
+
+def _covering_products(sources, zones, source_str, outdir, bounds=None):
+    """Looks in the cache index for merged DEMs of the same source covering
+    the merge of the tiles `sources` of `zones` (cropped to bounds, if
+    given).
+
+    The bounds of a product do not tell which tiles it was merged from
+    (some of them may have been left out, or missing at that time): a
+    product is only used if it was merged from all the tiles of `zones`
+    it overlaps.
+
+    Returns the list of these merged DEMs (a single one containing the
+    output if possible, all the ones intersecting it otherwise), and the
+    exact bounds of the output. The list is empty if they don't cover it.
+    """
+
+    index = _read_json(os.path.join(outdir, 'cache_index.json'))
+    prefix = source_str.lower() + os.sep
+    products = [(os.path.join(outdir, k), e['bounds'], e['zones'])
+                for k, e in sorted(index.items())
+                if k.startswith(prefix) and 'bounds' in e and 'zones' in e]
+    products = [pbz for pbz in products if os.path.exists(pbz[0])]
+    if not products:
+        return [], None
+
+    rfiles = [rasterio.open(s) for s in sources]
+    try:
+        eps = rfiles[0].transform.a * 1e-3
+        if bounds is None:
+            target = (min(r.bounds.left for r in rfiles),
+                      min(r.bounds.bottom for r in rfiles),
+                      max(r.bounds.right for r in rfiles),
+                      max(r.bounds.top for r in rfiles))
+        else:
+            target = _snap_bounds(rfiles, bounds)
+    finally:
+        for r in rfiles:
+            r.close()
+
+    def _overlaps(b, c):
+        return (b[0] < c[2] - eps and b[2] > c[0] + eps and
+                b[1] < c[3] - eps and b[3] > c[1] + eps)
+
+    def _complete(b, pzones):
+        # the tiles overlapping the product within the output
+        for z in zones:
+            x0, x1, y0, y1 = zone_bbox(z, source_str)
+            if z not in pzones and _overlaps(b, (x0, y0, x1, y1)):
+                return False
+        return True
+
+    w, s, e, n = target
+    products = [(p, b) for p, b, z in products
+                if _overlaps(b, target) and
+                _complete([max(b[0], w), max(b[1], s),
+                           min(b[2], e), min(b[3], n)], z)]
+
+    def _contains(b, x, y):
+        return (b[0] - eps <= x <= b[2] + eps and
+                b[1] - eps <= y <= b[3] + eps)
+
+    def _area(pb):
+        b = pb[1]
+        return (b[2] - b[0]) * (b[3] - b[1])
+
+    # the smallest product containing all
+    for p, b in sorted(products, key=_area):
+        if _contains(b, w, s) and _contains(b, e, n):
+            return [p], target
+
+    # or several of them: check the cells between all their edges
+    xs = sorted(set([w, e] + [x for _, b in products for x in (b[0], b[2])
+                              if w < x < e]))
+    ys = sorted(set([s, n] + [y for _, b in products for y in (b[1], b[3])
+                              if s < y < n]))
+    for x0, x1 in zip(xs[:-1], xs[1:]):
+        for y0, y1 in zip(ys[:-1], ys[1:]):
+            x, y = (x0 + x1) / 2, (y0 + y1) / 2
+            if not any(_contains(b, x, y) for _, b in products):
+                return [], None
+    return [p for p, _ in products], target
+
+
+def _snap_bounds(rfiles, bounds):
+    """Snaps bounds outwards to the pixel grid of the first raster, and
+    clips them to the union of the rasters."""
+
+    t = rfiles[0].transform
+    resx, resy = t.a, -t.e
+    w, s, e, n = bounds
+    w = t.c + np.floor(np.round((w - t.c) / resx, 6)) * resx
+    e = t.c + np.ceil(np.round((e - t.c) / resx, 6)) * resx
+    n = t.f - np.floor(np.round((t.f - n) / resy, 6)) * resy
+    s = t.f - np.ceil(np.round((t.f - s) / resy, 6)) * resy
+    w = max(w, min(r.bounds.left for r in rfiles))
+    s = max(s, min(r.bounds.bottom for r in rfiles))
+    e = min(e, max(r.bounds.right for r in rfiles))
+    n = min(n, max(r.bounds.top for r in rfiles))
+    return w, s, e, n
+
+
+# rasterio to GDAL data type names
+_GDAL_DTYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16',
+                'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+                'float32': 'Float32', 'float64': 'Float64'}
+
+
+def _write_vrt(sources, vrt_file, bounds=None):
+    """Writes a GDAL virtual mosaic of the sources if not done yet.
+
+    Where the rasters overlap the first valid one wins, like merge_tool.
+    If bounds are given, the mosaic is cropped to them.
+    """
+
+    if os.path.exists(vrt_file):
+        return
+
+    rfiles = [rasterio.open(s) for s in sources]
+    try:
+        t = rfiles[0].transform
+        resx, resy = t.a, -t.e
+        if bounds is None:
+            bounds = (min(r.bounds.left for r in rfiles),
+                      min(r.bounds.bottom for r in rfiles),
+                      max(r.bounds.right for r in rfiles),
+                      max(r.bounds.top for r in rfiles))
+        else:
+            bounds = _snap_bounds(rfiles, bounds)
+        w, s, e, n = [float(b) for b in bounds]
+        width = int(round((e - w) / resx))
+        height = int(round((n - s) / resy))
+
+        vrt_dir = os.path.dirname(os.path.abspath(vrt_file))
+        nodata = rfiles[0].nodata
+        lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'
+                 .format(width, height)]
+        if rfiles[0].crs is not None:
+            lines.append('  <SRS>{}</SRS>'.format(
+                xml_escape(rfiles[0].crs.to_wkt())))
+        lines.append('  <GeoTransform>{!r}, {!r}, 0.0, {!r}, 0.0, {!r}'
+                     '</GeoTransform>'.format(w, resx, n, -resy))
+        for b in range(1, rfiles[0].count + 1):
+            dtype = _GDAL_DTYPES[rfiles[0].dtypes[b-1]]
+            lines.append('  <VRTRasterBand dataType="{}" band="{}">'
+                         .format(dtype, b))
+            if nodata is not None:
+                lines.append('    <NoDataValue>{!r}</NoDataValue>'
+                             .format(nodata))
+            # later sources are painted over the previous ones
+            for src, r in reversed(list(zip(sources, rfiles))):
+                if src.startswith('/vsi'):
+                    fname, rel = src, 0
+                else:
+                    fname, rel = os.path.relpath(src, vrt_dir), 1
+                rw, rh = r.width, r.height
+                # (rounded, to avoid float noise in pixel positions)
+                xoff = round((r.bounds.left - w) / resx, 8)
+                yoff = round((n - r.bounds.top) / resy, 8)
+                xsize = round(rw * r.transform.a / resx, 8)
+                ysize = round(rh * -r.transform.e / resy, 8)
+                lines.append('    <ComplexSource>')
+                lines.append('      <SourceFilename relativeToVRT="{}">{}'
+                             '</SourceFilename>'
+                             .format(rel, xml_escape(fname)))
+                lines.append('      <SourceBand>{}</SourceBand>'.format(b))
+                lines.append('      <SrcRect xOff="0" yOff="0" xSize="{}" '
+                             'ySize="{}" />'.format(rw, rh))
+                lines.append('      <DstRect xOff="{!r}" yOff="{!r}" '
+                             'xSize="{!r}" ySize="{!r}" />'
+                             .format(xoff, yoff, xsize, ysize))
+                if r.nodata is not None:
+                    lines.append('      <NODATA>{!r}</NODATA>'
+                                 .format(r.nodata))
+                lines.append('    </ComplexSource>')
+            lines.append('  </VRTRasterBand>')
+        lines.append('</VRTDataset>')
+    finally:
+        for r in rfiles:
+            r.close()
+
+    with _atomic_output(vrt_file) as tmp:
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def _merge_topo_files(sources, merged_file, bounds=None, max_memory=None,
+                      output_profile=None):
+    """Merges the tiles into merged_file if not done yet.
+
+    If bounds are given, only the windows of the tiles within them are
+    read, and the output is cropped to them. If max_memory is given, the
+    output is written block by block (see _merge_blocks). The output
+    profile is the one of _raster_output.
+    """
+
+    if os.path.exists(merged_file):
+        return
+
+    rfiles = [rasterio.open(s) for s in sources]
+    try:
+        if bounds is not None:
+            bounds = _snap_bounds(rfiles, bounds)
+        if max_memory is not None:
+            _merge_blocks(rfiles, merged_file, bounds=bounds,
+                          max_memory=max_memory,
+                          output_profile=output_profile)
+            return
+        dest, output_transform = merge_tool(rfiles, bounds=bounds)
+        profile = rfiles[0].profile
+        if 'affine' in profile:
+            profile.pop('affine')
+        profile['transform'] = output_transform
+        profile['height'] = dest.shape[1]
+        profile['width'] = dest.shape[2]
+        profile['driver'] = 'GTiff'
+        with _raster_output(merged_file, output_profile) as tmp:
+            with rasterio.open(tmp, 'w', **profile) as dst:
+                dst.write(dest)
+    finally:
+        for r in rfiles:
+            r.close()
+
+
+def _read_mosaic(sources, bounds=None, out=None):
+    """Reads the mosaic of rasters sharing a pixel grid into an array.
+
+    Same as merge_tool (where the rasters overlap the first valid one wins),
+    but each raster is read directly into its window of the output, which
+    can be given. Returns the array and its transform.
+    """
+
+    rfiles = [rasterio.open(s) for s in sources]
+    try:
+        t = rfiles[0].transform
+        resx, resy = t.a, -t.e
+        if bounds is None:
+            bounds = (min(r.bounds.left for r in rfiles),
+                      min(r.bounds.bottom for r in rfiles),
+                      max(r.bounds.right for r in rfiles),
+                      max(r.bounds.top for r in rfiles))
+        else:
+            bounds = _snap_bounds(rfiles, bounds)
+        w, s, e, n = bounds
+        shape = (rfiles[0].count, int(round((n - s) / resy)),
+                 int(round((e - w) / resx)))
+        nodata = rfiles[0].nodata
+        if out is None:
+            out = np.empty(shape, dtype=rfiles[0].dtypes[0])
+        elif out.shape != shape:
+            raise ValueError('The output array should be of shape {}.'
+                             .format(shape))
+        out[:] = 0 if nodata is None else nodata
+        filled = np.zeros(shape, dtype=bool)
+
+        for r in rfiles:
+            # the window of the raster in the output, clipped to it
+            col = int(round((r.bounds.left - w) / resx))
+            row = int(round((n - r.bounds.top) / resy))
+            c0, c1 = max(col, 0), min(col + r.width, shape[2])
+            r0, r1 = max(row, 0), min(row + r.height, shape[1])
+            if c0 >= c1 or r0 >= r1:
+                continue
+            data = r.read(window=Window(c0 - col, r0 - row, c1 - c0,
+                                        r1 - r0))
+            valid = np.ones(data.shape, dtype=bool)
+            if r.nodata is not None:
+                valid = data != r.nodata
+            todo = valid & ~filled[:, r0:r1, c0:c1]
+            out[:, r0:r1, c0:c1][todo] = data[todo]
+            filled[:, r0:r1, c0:c1] |= valid
+    finally:
+        for r in rfiles:
+            r.close()
+
+    return out, Affine(resx, 0., w, 0., -resy, n)
+
+
+def _merge_blocks(rfiles, merged_file, bounds=None, max_memory=2**28,
+                  output_profile=None):
+    """Merges open rasters into a tiled GeoTIFF, one strip of rows at a time.
+
+    Each strip is merged with merge_tool on its own bounds, so that only the
+    windows of the sources within the strip are read. The strip height is
+    chosen so that the merged strip needs about max_memory bytes (at least
+    one row, and whole tiles of the output when possible). The result is
+    the same as merging everything at once.
+    """
+
+    t = rfiles[0].transform
+    resx, resy = t.a, -t.e
+    if bounds is None:
+        bounds = (min(r.bounds.left for r in rfiles),
+                  min(r.bounds.bottom for r in rfiles),
+                  max(r.bounds.right for r in rfiles),
+                  max(r.bounds.top for r in rfiles))
+    w, s, e, n = bounds
+    width = int(round((e - w) / resx))
+    height = int(round((n - s) / resy))
+
+    profile = rfiles[0].profile
+    if 'affine' in profile:
+        profile.pop('affine')
+    profile.update(driver='GTiff', width=width, height=height,
+                   transform=Affine(resx, 0., w, 0., -resy, n),
+                   tiled=True, blockxsize=256, blockysize=256)
+
+    itemsize = np.dtype(rfiles[0].dtypes[0]).itemsize
+    row_bytes = width * rfiles[0].count * itemsize
+    nrows = max(1, int(max_memory // row_bytes))
+    if nrows >= 256:
+        nrows -= nrows % 256
+
+    with _raster_output(merged_file, output_profile) as tmp:
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            for row in range(0, height, nrows):
+                h = min(nrows, height - row)
+                top = n - row * resy
+                dest, _ = merge_tool(rfiles, res=(resx, resy),
+                                     bounds=(w, top - h * resy, e, top))
+                dst.write(dest[:, :h, :width],
+                          window=Window(0, row, width, h))
+
+
+async def _run_in_executor(func, *args, semaphore=None, executor=None):
+    """Runs a blocking call in an executor, bounded by the semaphore."""
+
+    try:
+        loop = asyncio.get_running_loop()
+    except AttributeError:
+        # python < 3.7: the loop running this coroutine
+        loop = asyncio.get_event_loop()
+    if semaphore is None:
+        return await loop.run_in_executor(executor, func, *args)
+    async with semaphore:
+        return await loop.run_in_executor(executor, func, *args)
+
+
+async def aget_topo_file(lon_ex, lat_ex, outdir, rgi_region=None,
+                         source=None, crop_buffer=None, output_format='GTiff',
+                         max_memory=None, output_profile=None,
+                         storage='extract', cache_budget=None,
+                         missing_expiry=None, semaphore=None, executor=None):
+    """Asynchronous version of get_topo_file.
+
+    Each tile is downloaded in a job of its own and the merge runs in an
+    executor, so the event loop is never blocked. Many extents can be
+    processed concurrently on the same loop (e.g. with ``asyncio.gather``),
+    sharing a semaphore to bound the number of parallel jobs.
+
+    Parameters
+    ----------
+    lon_ex, lat_ex, outdir, rgi_region, source : see get_topo_file.
+    crop_buffer, output_format, max_memory : see get_topo_file.
+    output_profile, storage, cache_budget, missing_expiry : see
+        get_topo_file.
+    semaphore : asyncio.Semaphore, optional
+        Bounds the number of downloads and merges running at the same time.
+        Share it between calls to bound the total concurrency.
+    executor : concurrent.futures.Executor, optional
+        Where to run the blocking jobs (default: the loop's executor).
+
+    Returns
+    -------
+    tuple: (path to the DEM file, data source).
+    """
+
+    kwargs = dict(semaphore=semaphore, executor=executor)
+
+    # If a list of possible sources is given, process them successively
+    if source is not None and not isinstance(source, string_types):
+        for s in source:
+            demf, source_str = await aget_topo_file(
+                lon_ex, lat_ex, outdir, rgi_region=rgi_region, source=s,
+                crop_buffer=crop_buffer, output_format=output_format,
+                max_memory=max_memory, output_profile=output_profile,
+                storage=storage, cache_budget=cache_budget,
+                missing_expiry=missing_expiry, **kwargs)
+            if rasterio.shutil.exists(demf):
+                return demf, source_str
+        raise RuntimeError('No topography file available!')
+
+    source = _topo_source(lon_ex, lat_ex, rgi_region=rgi_region,
+                          source=source)
+    if source == 'ETOPO1':
+        return _etopo1_file(outdir), 'ETOPO1'
+
+    zones, download_func = _topo_zones(lon_ex, lat_ex, source,
+                                       max_memory=max_memory,
+                                       output_profile=output_profile,
+                                       storage=storage,
+                                       missing_expiry=missing_expiry)
+    sources = await asyncio.gather(*[_run_in_executor(download_func, z,
+                                                      outdir, **kwargs)
+                                     for z in zones])
+    merge = functools.partial(_merged_topo_file,
+                              bounds=_crop_bounds(lon_ex, lat_ex, crop_buffer),
+                              output_format=output_format,
+                              max_memory=max_memory,
+                              output_profile=output_profile,
+                              cache_budget=cache_budget)
+    return await _run_in_executor(merge, list(sources), zones, source, outdir,
+                                  **kwargs)
+
+
+async def aget_rgi_data(outdir, version='5.0', regions=None, semaphore=None,
+                        executor=None):
+    """Asynchronous version of get_rgi_data (see there)."""
+    return await _run_in_executor(get_rgi_data, outdir, version, regions,
+                                  semaphore=semaphore, executor=executor)
+
+
+async def aget_cru_file(outdir, var=None, semaphore=None, executor=None):
+    """Asynchronous version of get_cru_file (see there)."""
+    return await _run_in_executor(get_cru_file, outdir, var,
+                                  semaphore=semaphore, executor=executor)
+
+
 def get_postgresql_data(connectargs, statement):
     """
     Retrieves data from a PostgreSQL database as `pandas.DataFrame`.
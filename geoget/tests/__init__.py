@@ -4,10 +4,13 @@ import os
 import sys
 import unittest
 import logging
+import threading
+import hashlib
 import matplotlib
 import numpy as np
 from six.moves.urllib.request import urlopen
 from six.moves.urllib.error import URLError
+from six.moves import BaseHTTPServer, socketserver
 from configobj import ConfigObj, ConfigObjError
 
 
@@ -81,6 +84,119 @@ def is_download(test):
     return test if RUN_DOWNLOAD_TESTS else unittest.skip(msg)(test)
 
 
+class LocalHTTPServer(object):
+    """A small HTTP server on localhost, standing in for the data servers.
+
+    Use it as context manager. ``url(path)`` gives the URL of a file.
+
+    Parameters
+    ----------
+    files: dict
+        {'/path': bytes} the content to serve
+    ranges: bool
+        whether to honour the Range requests
+    fail_after: int
+        if set, the first response of each file is interrupted after
+        this number of bytes (the connection is dropped)
+    redirects: dict
+        {'/path': '/other_path'} paths answered with a 302 redirect
+    etags: bool
+        whether to send an ETag (the md5 of the file), and honour the
+        If-Range requests
+    """
+
+    def __init__(self, files, ranges=True, fail_after=None, redirects=None,
+                 etags=True):
+
+        self.files = files
+        self.redirects = redirects or dict()
+        self.ranges = ranges
+        self.fail_after = fail_after
+        self.etags = etags
+        self.requests = []  # (path, headers) of all requests
+        self.connections = set()  # client addresses
+        self._failed = set()
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append((self.path, self.headers))
+                server.connections.add(self.client_address)
+                if self.path in server.redirects:
+                    self.send_response(302)
+                    self.send_header('Location', server.redirects[self.path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path not in server.files:
+                    self.send_error(404)
+                    return
+                data = server.files[self.path]
+                etag = server.etag(self.path)
+                start = 0
+                rng = self.headers.get('Range')
+                if_range = self.headers.get('If-Range')
+                if server.etags and if_range is not None and \
+                        if_range != etag:
+                    # the file changed: send it all
+                    rng = None
+                if server.ranges and rng is not None:
+                    start = int(rng.split('=')[1].split('-')[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header('Content-Range',
+                                         'bytes */{}'.format(len(data)))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                body = data[start:]
+                if server.etags:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if server.fail_after is not None and \
+                        self.path not in server._failed:
+                    server._failed.add(self.path)
+                    self.wfile.write(body[:server.fail_after])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+
+    def etag(self, path):
+        return '"{}"'.format(hashlib.md5(self.files[path]).hexdigest())
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.httpd.server_address[1],
+                                              path)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 # the code below is copy/pasted from xarray
 # TODO: go back to xarray when https://github.com/pydata/xarray/issues/754
 def assertEqual(a1, a2):
@@ -3,8 +3,30 @@ import warnings
 import unittest
 import os
 import shutil
+import glob
+import time
+import hashlib
+import threading
+import zipfile
+import gzip
+import io
+import zlib
+import asyncio
+from unittest import mock
+import filelock
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+import rasterio
+from affine import Affine
 import salem
-from geoget.tests import is_download, is_slow, requires_credentials, cred
+import shapely.geometry as shpg
+import geopandas as gpd
+from six.moves.urllib.error import HTTPError, ContentTooShortError
+from six.moves.http_client import IncompleteRead
+from geoget.tests import (is_download, is_slow, requires_credentials, cred,
+                          LocalHTTPServer)
 from geoget import core
 
 # Setting for warnings
@@ -17,6 +39,55 @@ if not os.path.exists(TEST_DIR):
     os.makedirs(TEST_DIR)
 
 
+def make_srtm_tile(outdir, zone, npix=50):
+    """Writes a small synthetic SRTM tile, so that no download is needed."""
+
+    zx, zy = [int(z) for z in zone.split('_')]
+    west = -180. + 5 * (zx - 1)
+    north = 60. - 5 * (zy - 1)
+    res = 5. / npix
+    data = np.arange(npix * npix).reshape((npix, npix)) % 1000
+    data = (data + zx * 10 + zy).astype(np.int16)
+    profile = dict(driver='GTiff', height=npix, width=npix, count=1,
+                   dtype='int16', crs='EPSG:4326', nodata=-32768,
+                   transform=Affine(res, 0., west, 0., -res, north))
+    path = os.path.join(outdir, 'srtm_' + zone + '.tif')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def make_dem3_archive(outdir, zone, names, dirname=None):
+    """Writes a small DEM3 archive of synthetic .hgt files (in the folder
+    `dirname`, the zone by default)."""
+
+    zfile = os.path.join(outdir, 'dem3_' + zone + '.zip')
+    with zipfile.ZipFile(zfile, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i, name in enumerate(names):
+            data = np.arange(1201 * 1201) % 3000 + i
+            zf.writestr((dirname or zone) + '/' + name + '.hgt',
+                        data.astype('>i2').tobytes())
+    return zfile
+
+
+def make_cru_file(outdir, var, nyears=2):
+    """Writes a synthetic CRU TS file on the 0.5 degree grid of CRU, where
+    get_cru_file expects it."""
+
+    time = pd.date_range('1901-01-01', periods=12 * nyears, freq='MS')
+    lat = np.arange(-89.75, 90., 0.5)
+    lon = np.arange(-179.75, 180., 0.5)
+    data = np.random.RandomState(0).rand(len(time), len(lat), len(lon))
+    ds = xr.Dataset({var: (('time', 'lat', 'lon'), data.astype(np.float32)),
+                     'stn': (('time', 'lat', 'lon'),
+                             (data * 8).astype(np.int32))},
+                    coords={'time': time, 'lat': lat, 'lon': lon},
+                    attrs={'title': 'CRU TS3.23 Mean Temperature'})
+    path = os.path.join(outdir, 'cru_ts3.23.1901.2014.{}.dat.nc'.format(var))
+    ds.to_netcdf(path, unlimited_dims=['time'])
+    return path
+
+
 class TestFuncs(unittest.TestCase):
 
     def setUp(self):
@@ -25,6 +96,988 @@ class TestFuncs(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def test_download_zones(self):
+
+        def _dl(zone, outdir):
+            # the slowest zone comes first
+            time.sleep(0.05 * (3 - int(zone)))
+            return os.path.join(outdir, zone)
+
+        zones = ['0', '1', '2', '3']
+        ref = core._download_zones(_dl, zones, TEST_DIR)
+        self.assertEqual(ref, [os.path.join(TEST_DIR, z) for z in zones])
+        out = core._download_zones(_dl, zones, TEST_DIR, max_workers=4)
+        self.assertEqual(ref, out)
+
+    def test_file_lock(self):
+
+        f1 = os.path.join(TEST_DIR, 'srtm_01_01.zip')
+        f2 = os.path.join(TEST_DIR, 'srtm_01_02.zip')
+        with core.get_file_lock(f1):
+            self.assertTrue(os.path.exists(f1 + '.lock'))
+            # another tile is not blocked
+            with core.get_file_lock(f2):
+                pass
+            # the same tile is
+            with self.assertRaises(filelock.Timeout):
+                filelock.FileLock(f1 + '.lock').acquire(timeout=0.1)
+
+        with self.assertWarns(DeprecationWarning):
+            with core.get_download_lock(TEST_DIR):
+                pass
+
+    def test_missing_tiles(self):
+
+        tdir = os.path.join(TEST_DIR, 'missing')
+        core.mkdir(tdir, reset=True)
+        self.assertFalse(core._is_missing_tile(tdir, 'srtm_41_20.zip'))
+        core._record_missing_tile(tdir, 'srtm_41_20.zip')
+        core._record_missing_tile(tdir, 'dem3_SA01.zip')
+        self.assertTrue(core._is_missing_tile(tdir, 'srtm_41_20.zip'))
+        self.assertTrue(core._is_missing_tile(tdir, 'dem3_SA01.zip'))
+        self.assertTrue(core._is_missing_tile(tdir, 'srtm_41_20.zip',
+                                              expiry=3600))
+        self.assertFalse(core._is_missing_tile(tdir, 'srtm_41_20.zip',
+                                               expiry=0))
+
+        # no network needed
+        self.assertIsNone(core.download_srtm_file('41_20', tdir))
+        self.assertIsNone(core.download_dem3_viewpano('SA01', tdir))
+
+    def test_bad_archive(self):
+
+        tdir = os.path.join(TEST_DIR, 'bad_archive')
+        core.mkdir(tdir, reset=True)
+        for storage in ['extract', 'zip']:
+            for fname in ['srtm_38_04.zip', 'dem3_L32.zip']:
+                with open(os.path.join(tdir, fname), 'w') as f:
+                    f.write('<html>Service unavailable</html>')
+            self.assertIsNone(core.download_srtm_file('38_04', tdir,
+                                                      storage=storage))
+            self.assertIsNone(core.download_dem3_viewpano('L32', tdir,
+                                                          storage=storage))
+            # removed, and not taken for missing tiles
+            self.assertFalse(os.path.exists(os.path.join(tdir,
+                                                         'srtm_38_04.zip')))
+            self.assertFalse(os.path.exists(os.path.join(tdir,
+                                                         'dem3_L32.zip')))
+            self.assertFalse(os.path.exists(os.path.join(
+                tdir, 'missing_tiles.json')))
+
+    def test_tile_catalog(self):
+
+        tdir = os.path.join(TEST_DIR, 'catalog')
+        core.mkdir(tdir, reset=True)
+        cat = os.path.join(tdir, 'tile_catalog.json')
+        core.build_tile_catalog('SRTM', ['38_04', '39_04'], tdir)
+        core.build_tile_catalog('DEM3', ['L32', 'SA01', 'ISL', 'SR15'], tdir)
+        with self.assertRaises(ValueError):
+            core.build_tile_catalog('SRTM', ['73_01'], tdir)
+        self.assertEqual(core._read_tile_catalog(cat, 'SRTM'),
+                         {'38_04', '39_04'})
+        self.assertEqual(core._read_tile_catalog(cat, 'DEM3'),
+                         {'L32', 'SA01', 'ISL', 'SR15'})
+
+        with mock.patch.object(core, '_download_srtm_file_unlocked',
+                               return_value='x') as srtm, \
+                mock.patch.object(core, '_download_dem3_viewpano_unlocked',
+                                  return_value='x') as dem3:
+            # no network needed for the tiles not in the catalog
+            self.assertIsNone(core.download_srtm_file('41_20', tdir))
+            self.assertIsNone(core.download_dem3_viewpano('SB01', tdir))
+            self.assertEqual(srtm.call_count + dem3.call_count, 0)
+            self.assertEqual(core.download_srtm_file('38_04', tdir), 'x')
+            self.assertEqual(core.download_dem3_viewpano('ISL', tdir), 'x')
+            # without catalog, all tiles are asked for
+            os.remove(cat)
+            self.assertEqual(core.download_srtm_file('41_20', tdir), 'x')
+
+    def test_atomic_output(self):
+
+        of = os.path.join(TEST_DIR, 'atomic.txt')
+        if os.path.exists(of):
+            os.remove(of)
+
+        # a failed write leaves nothing behind
+        with self.assertRaises(RuntimeError):
+            with core._atomic_output(of) as tmp:
+                with open(tmp, 'w') as f:
+                    f.write('half')
+                self.assertFalse(os.path.exists(of))
+                raise RuntimeError()
+        self.assertFalse(os.path.exists(of))
+        self.assertFalse(any(f.endswith('.tmp') for f in os.listdir(TEST_DIR)))
+
+        with core._atomic_output(of) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('full')
+        with open(of) as f:
+            self.assertEqual(f.read(), 'full')
+
+        # zip extraction
+        zf = os.path.join(TEST_DIR, 'test.zip')
+        with zipfile.ZipFile(zf, 'w') as z:
+            z.writestr('a.txt', 'a')
+            z.writestr('sub/b.txt', 'b')
+        odir = os.path.join(TEST_DIR, 'extracted')
+        core._extract_zip(zf, odir)
+        self.assertEqual(sorted(os.listdir(odir)), ['a.txt', 'sub'])
+        with open(os.path.join(odir, 'sub', 'b.txt')) as f:
+            self.assertEqual(f.read(), 'b')
+
+    def test_gunzip(self):
+
+        # binary data with a few line ends, in two gzip members
+        data = np.random.RandomState(0).randint(0, 20, 300000)
+        data = data.astype(np.uint8).tobytes()
+        gz = gzip.compress(data[:100000]) + gzip.compress(data[100000:])
+
+        calls = []
+        out = io.BytesIO()
+        size = core._gunzip(io.BytesIO(gz), out, total=len(gz),
+                            reporthook=lambda *a: calls.append(a),
+                            block_size=4096)
+        self.assertEqual(size, len(data))
+        self.assertEqual(out.getvalue(), data)
+        self.assertEqual(calls[0], (0, 4096, len(gz)))
+        self.assertEqual(len(calls), -(-len(gz) // 4096) + 1)
+
+        # zero padding, also between members and across blocks
+        out = io.BytesIO()
+        padded = gzip.compress(b'abc') + b'\0' * 5000 + gzip.compress(b'de')
+        core._gunzip(io.BytesIO(padded + b'\0' * 8), out, block_size=4096)
+        self.assertEqual(out.getvalue(), b'abcde')
+
+        # truncated data
+        with self.assertRaises(EOFError):
+            core._gunzip(io.BytesIO(gz[:-100]), io.BytesIO())
+        with self.assertRaises(EOFError):
+            core._gunzip(io.BytesIO(b''), io.BytesIO())
+        # not gzip data after a member
+        with self.assertRaises(zlib.error):
+            core._gunzip(io.BytesIO(gz + b'garbage'), io.BytesIO())
+        # wrong size in the gzip trailer
+        bad = gz[:-4] + (len(data) + 1).to_bytes(4, 'little')
+        with self.assertRaises(zlib.error):
+            core._gunzip(io.BytesIO(bad), io.BytesIO())
+
+class TestDownloads(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.join(TEST_DIR, 'downloads')
+        core.mkdir(self.testdir, reset=True)
+        self.data = os.urandom(100000)
+
+    def tearDown(self):
+        pass
+
+    def test_resume(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with LocalHTTPServer({'/file.zip': self.data},
+                             fail_after=30000) as server:
+            # without retry the partial file is kept
+            with self.assertRaises(ContentTooShortError):
+                core._urlretrieve(server.url('/file.zip'), of, retry=0)
+            self.assertFalse(os.path.exists(of))
+            self.assertEqual(os.path.getsize(of + '.part'), 30000)
+
+            # and continued at the next call
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(server.requests[-1][1]['Range'], 'bytes=30000-')
+
+        self.assertFalse(os.path.exists(of + '.part'))
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_resume_in_retry(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with LocalHTTPServer({'/file.zip': self.data},
+                             fail_after=30000) as server:
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(len(server.requests), 2)
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_resume_complete_part(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with open(of + '.part', 'wb') as f:
+            f.write(self.data)
+        with LocalHTTPServer({'/file.zip': self.data}) as server:
+            core._write_part_info(of + '.part', server.etag('/file.zip'),
+                                  len(self.data))
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(len(server.requests), 1)
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(of + '.part.json'))
+
+    def test_resume_changed_file(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with LocalHTTPServer({'/file.zip': self.data},
+                             fail_after=30000) as server:
+            with self.assertRaises(ContentTooShortError):
+                core._urlretrieve(server.url('/file.zip'), of, retry=0)
+
+        # same size, other content
+        new_data = os.urandom(100000)
+        with LocalHTTPServer({'/file.zip': new_data}) as server:
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(server.requests[-1][1]['If-Range'],
+                             '"{}"'.format(hashlib.md5(self.data).hexdigest()))
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), new_data)
+
+        # without validator, the total size is checked
+        os.remove(of)
+        with LocalHTTPServer({'/file.zip': self.data}, etags=False,
+                             fail_after=30000) as server:
+            with self.assertRaises(ContentTooShortError):
+                core._urlretrieve(server.url('/file.zip'), of, retry=0)
+        with LocalHTTPServer({'/file.zip': new_data[:90000]},
+                             etags=False) as server:
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(len(server.requests), 2)
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), new_data[:90000])
+
+    def test_resume_unknown_part(self):
+
+        # a part file of unknown origin is not continued
+        of = os.path.join(self.testdir, 'file.zip')
+        with open(of + '.part', 'wb') as f:
+            f.write(b'garbage')
+        with LocalHTTPServer({'/file.zip': self.data}) as server:
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertNotIn('Range', server.requests[-1][1])
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_no_ranges(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with open(of + '.part', 'wb') as f:
+            f.write(b'garbage')
+        with LocalHTTPServer({'/file.zip': self.data},
+                             ranges=False) as server:
+            core._write_part_info(of + '.part', server.etag('/file.zip'),
+                                  len(self.data))
+            core._urlretrieve(server.url('/file.zip'), of)
+            self.assertEqual(server.requests[-1][1]['Range'], 'bytes=7-')
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_404(self):
+
+        of = os.path.join(self.testdir, 'file.zip')
+        with LocalHTTPServer({}) as server:
+            with self.assertRaises(HTTPError) as cm:
+                core._urlretrieve(server.url('/file.zip'), of)
+        self.assertEqual(cm.exception.code, 404)
+        self.assertFalse(os.path.exists(of))
+
+    def test_gunzip_download(self):
+
+        of = os.path.join(self.testdir, 'file.nc')
+        gz = gzip.compress(self.data)
+        with LocalHTTPServer({'/file.nc.gz': gz},
+                             fail_after=30000) as server:
+            # without retry nothing is left behind
+            with self.assertRaises((EOFError, IncompleteRead)):
+                core._urlretrieve_gunzip(server.url('/file.nc.gz'), of,
+                                         retry=0)
+            self.assertEqual(os.listdir(self.testdir), [])
+
+        with LocalHTTPServer({'/file.nc.gz': gz},
+                             fail_after=30000) as server:
+            # an interrupted transfer is started again
+            core._urlretrieve_gunzip(server.url('/file.nc.gz'), of)
+            self.assertEqual(len(server.requests), 2)
+            self.assertNotIn('Range', server.requests[-1][1])
+
+        # no compressed or partial file
+        self.assertEqual(os.listdir(self.testdir), ['file.nc'])
+        with open(of, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_cru_download(self):
+
+        gz = gzip.compress(self.data)
+        ofile = os.path.join(self.testdir,
+                             'cru_ts3.23.1901.2014.tmp.dat.nc')
+        with LocalHTTPServer({'/tmp.dat.gz': gz}) as server:
+            retrieve = core.progress_urlretrieve
+
+            def _local(url, ofile, **kwargs):
+                return retrieve(server.url('/tmp.dat.gz'), ofile, **kwargs)
+            with mock.patch.object(core, 'progress_urlretrieve', _local):
+                self.assertEqual(core.get_cru_file(self.testdir, 'tmp'),
+                                 ofile)
+        self.assertFalse(os.path.exists(ofile + '.gz'))
+        with open(ofile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        # the archives of earlier versions are decompressed
+        os.remove(ofile)
+        with open(ofile + '.gz', 'wb') as f:
+            f.write(gz)
+        with mock.patch.object(core, 'progress_urlretrieve') as dl:
+            core.get_cru_file(self.testdir, 'tmp')
+            self.assertEqual(dl.call_count, 0)
+        with open(ofile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_rgi_regions(self):
+
+        # an RGI archive of region archives
+        rgi = io.BytesIO()
+        with zipfile.ZipFile(rgi, 'w') as zf:
+            for reg in ['01_rgi50_Alaska', '11_rgi50_CentralEurope']:
+                sub = io.BytesIO()
+                with zipfile.ZipFile(sub, 'w') as szf:
+                    for ext in ['.shp', '.dbf']:
+                        szf.writestr(reg + ext, reg + ext)
+                zf.writestr(reg + '.zip', sub.getvalue())
+            zf.writestr('00_rgi50_summary.csv', 'summary')
+        with open(os.path.join(self.testdir, 'rgi50.zip'), 'wb') as f:
+            f.write(rgi.getvalue())
+
+        def _regions():
+            return sorted(d for d in os.listdir(self.testdir)
+                          if os.path.isdir(os.path.join(self.testdir, d)))
+
+        # only the asked regions are extracted
+        rgi_dir = core.get_rgi_data(self.testdir, regions=[11])
+        self.assertEqual(rgi_dir, self.testdir)
+        self.assertEqual(_regions(), ['11_rgi50_CentralEurope'])
+        of = os.path.join(rgi_dir, '11_rgi50_CentralEurope',
+                          '11_rgi50_CentralEurope.shp')
+        with open(of) as f:
+            self.assertEqual(f.read(), '11_rgi50_CentralEurope.shp')
+        self.assertFalse(any(f.endswith('.zip') and f != 'rgi50.zip'
+                             for f in os.listdir(rgi_dir)))
+
+        # once
+        with mock.patch.object(core, '_extract_rgi_region') as ex:
+            core.get_rgi_data(self.testdir, regions=['11'])
+            self.assertEqual(ex.call_count, 0)
+        with self.assertRaises(ValueError):
+            core.get_rgi_data(self.testdir, regions=[11, 19])
+
+        # also asynchronously
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(core.aget_rgi_data(self.testdir,
+                                                       regions=[1]))
+        finally:
+            loop.close()
+        self.assertEqual(_regions(), ['01_rgi50_Alaska',
+                                      '11_rgi50_CentralEurope'])
+
+        # all of them by default
+        shutil.rmtree(os.path.join(self.testdir, '11_rgi50_CentralEurope'))
+        core.get_rgi_data(self.testdir)
+        self.assertEqual(_regions(), ['01_rgi50_Alaska',
+                                      '11_rgi50_CentralEurope'])
+
+    def test_http_session(self):
+
+        session = core.HTTPSession()
+        files = {'/a': b'a' * 1000, '/b': b'b' * 1000}
+        with LocalHTTPServer(files, redirects={'/c': '/b'}) as server:
+            for p in ['/a', '/b', '/c', '/a']:
+                with session.open(server.url(p)) as resp:
+                    self.assertEqual(resp.getcode(), 200)
+                    self.assertEqual(resp.read(), files.get(p, files['/b']))
+            # all requests went through the same connection
+            self.assertEqual(len(server.requests), 5)
+            self.assertEqual(len(server.connections), 1)
+            with self.assertRaises(HTTPError) as cm:
+                session.open(server.url('/d'))
+            self.assertEqual(cm.exception.code, 404)
+        session.clear()
+
+
+class TestTopo(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.join(TEST_DIR, 'topo')
+        core.mkdir(self.testdir, reset=True)
+        # the Alps
+        self.lon_ex = [6, 14]
+        self.lat_ex = [41, 48]
+        for z in core.srtm_zone(self.lon_ex, self.lat_ex):
+            make_srtm_tile(self.testdir, z)
+
+    def tearDown(self):
+        pass
+
+    def test_get_topo_file(self):
+
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                     max_workers=4)
+        self.assertEqual(src, 'SRTM_MERGED')
+        with rasterio.open(fp) as ds:
+            self.assertEqual(ds.shape, (100, 100))
+            self.assertEqual(ds.bounds, (5., 40., 15., 50.))
+
+        fp, src = core.get_topo_file([6, 7], [41, 42], self.testdir)
+        self.assertEqual(src, 'SRTM')
+        self.assertEqual(fp, os.path.join(self.testdir, 'srtm_38_04.tif'))
+
+    def test_crop(self):
+
+        fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+        with rasterio.open(fp) as ds:
+            ref = ds.read(1)
+
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                     crop_buffer=0.5)
+        self.assertEqual(src, 'SRTM_MERGED')
+        with rasterio.open(fp) as ds:
+            self.assertEqual(ds.bounds, (5.5, 40.5, 14.5, 48.5))
+            self.assertEqual(ds.shape, (80, 90))
+            np.testing.assert_array_equal(ds.read(1), ref[15:95, 5:95])
+
+        # not aligned on pixels: the output is larger
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                     crop_buffer=0.55)
+        with rasterio.open(fp) as ds:
+            np.testing.assert_allclose(ds.bounds, (5.4, 40.4, 14.6, 48.6))
+            np.testing.assert_array_equal(ds.read(1), ref[14:96, 4:96])
+
+        # ...and clipped to the tiles
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                     crop_buffer=2)
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(1), ref)
+
+    def test_vrt(self):
+
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                     output_format='VRT')
+        self.assertEqual(src, 'SRTM_MERGED')
+        self.assertTrue(fp.endswith('.vrt'))
+        self.assertLess(os.path.getsize(fp), 10000)
+        with rasterio.open(ref) as ds:
+            ref_bounds = ds.bounds
+            ref = ds.read()
+        with rasterio.open(fp) as ds:
+            self.assertEqual(ds.bounds, ref_bounds)
+            self.assertEqual(ds.nodata, -32768)
+            np.testing.assert_array_equal(ds.read(), ref)
+
+        # cropped
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                    crop_buffer=0.55)
+        fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                   crop_buffer=0.55, output_format='VRT')
+        with rasterio.open(ref) as ds:
+            ref = ds.read()
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(), ref)
+
+        with self.assertRaises(ValueError):
+            core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                               output_format='PNG')
+
+    def test_max_memory(self):
+
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+        with rasterio.open(ref) as ds:
+            ref_bounds = ds.bounds
+            ref = ds.read()
+
+        # in another dir, to avoid the cached files
+        bdir = os.path.join(self.testdir, 'blocks')
+        core.mkdir(bdir)
+        for z in core.srtm_zone(self.lon_ex, self.lat_ex):
+            make_srtm_tile(bdir, z)
+
+        # a few rows at a time
+        with mock.patch.object(core, 'merge_tool',
+                               wraps=core.merge_tool) as merge:
+            fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, bdir,
+                                       max_memory=1000)
+            self.assertEqual(merge.call_count, 20)
+        with rasterio.open(fp) as ds:
+            self.assertEqual(ds.bounds, ref_bounds)
+            self.assertEqual(ds.block_shapes, [(256, 256)])
+            np.testing.assert_array_equal(ds.read(), ref)
+
+        # cropped
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                    crop_buffer=0.55)
+        fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, bdir,
+                                   crop_buffer=0.55, max_memory=1000)
+        with rasterio.open(ref) as ds:
+            ref = ds.read()
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(), ref)
+
+    def test_cog(self):
+
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+        with rasterio.open(ref) as ds:
+            self.assertEqual(ds.overviews(1), [])
+            ref = ds.read()
+
+        for max_memory in [None, 1000]:
+            cdir = os.path.join(self.testdir, 'cog{}'.format(max_memory))
+            core.mkdir(cdir)
+            for z in core.srtm_zone(self.lon_ex, self.lat_ex):
+                make_srtm_tile(cdir, z)
+            fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, cdir,
+                                       max_memory=max_memory,
+                                       output_profile={'blockxsize': 16,
+                                                       'blockysize': 16})
+            self.assertFalse(glob.glob(os.path.join(cdir, 'srtm', '*.tmp*')))
+            with rasterio.open(fp) as ds:
+                self.assertEqual(ds.compression.value, 'DEFLATE')
+                self.assertEqual(ds.block_shapes, [(16, 16)])
+                self.assertEqual(ds.overviews(1), [2, 4])
+                np.testing.assert_array_equal(ds.read(), ref)
+
+        with self.assertRaises(ValueError):
+            core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                               crop_buffer=1, output_profile='JPEG')
+
+    def test_zip_storage(self):
+
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                    crop_buffer=0.5)
+        with rasterio.open(ref) as ds:
+            ref = ds.read()
+
+        # only the archives of the tiles
+        zdir = os.path.join(self.testdir, 'zipped')
+        core.mkdir(zdir)
+        for z in core.srtm_zone(self.lon_ex, self.lat_ex):
+            tif = make_srtm_tile(zdir, z)
+            with zipfile.ZipFile(tif[:-4] + '.zip', 'w',
+                                 zipfile.ZIP_DEFLATED) as zf:
+                zf.write(tif, os.path.basename(tif))
+            os.remove(tif)
+
+        fp, src = core.get_topo_file([6, 7], [41, 42], zdir, storage='zip')
+        self.assertEqual(src, 'SRTM')
+        self.assertTrue(fp.startswith('/vsizip/'))
+        fp, src = core.get_topo_file(self.lon_ex, self.lat_ex, zdir,
+                                     crop_buffer=0.5, storage='zip')
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(), ref)
+        self.assertFalse(glob.glob(os.path.join(zdir, 'srtm_*.tif')))
+
+        with self.assertRaises(ValueError):
+            core.download_srtm_file('38_04', zdir, storage='tar')
+
+    def test_dem3_zip_storage(self):
+
+        # a fake DEM3 archive of two .hgt files
+        zdir = os.path.join(self.testdir, 'dem3')
+        core.mkdir(zdir)
+        make_dem3_archive(zdir, 'L32', ['N46E007', 'N46E008'])
+
+        vrt = core.download_dem3_viewpano('L32', zdir, storage='zip')
+        self.assertEqual(vrt, os.path.join(zdir, 'L32.vrt'))
+        # nothing extracted
+        self.assertFalse(os.path.exists(os.path.join(zdir, 'L32')))
+
+        # same as the extracted and merged tiles
+        tif = core.download_dem3_viewpano('L32', zdir)
+        self.assertEqual(tif, os.path.join(zdir, 'L32.tif'))
+        with rasterio.open(vrt) as ds, rasterio.open(tif) as ref:
+            self.assertEqual(ds.bounds, ref.bounds)
+            np.testing.assert_array_equal(ds.read(), ref.read())
+
+    def test_get_topo_array(self):
+
+        for buffer in [None, 0.55, 2]:
+            fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex,
+                                       self.testdir, crop_buffer=buffer)
+            with rasterio.open(fp) as ds:
+                ref = ds.read()
+                ref_transform = ds.transform
+            dem, transform, src = core.get_topo_array(self.lon_ex,
+                                                      self.lat_ex,
+                                                      self.testdir,
+                                                      crop_buffer=buffer)
+            self.assertEqual(src, 'SRTM')
+            np.testing.assert_array_equal(dem, ref)
+            np.testing.assert_allclose(tuple(transform),
+                                       tuple(ref_transform))
+
+        # in a given buffer, with a partly missing tile
+        os.remove(os.path.join(self.testdir, 'srtm_38_04.tif'))
+        core._record_missing_tile(self.testdir, 'srtm_38_04.zip')
+        out = np.zeros((1, 100, 100), dtype=np.float32)
+        dem, _, _ = core.get_topo_array(self.lon_ex, self.lat_ex,
+                                        self.testdir, out=out)
+        self.assertIs(dem, out)
+        self.assertTrue(np.all(out[:, 50:, :50] == -32768))
+        np.testing.assert_array_equal(out[:, :50], ref[:, :50])
+        np.testing.assert_array_equal(out[:, 50:, 50:], ref[:, 50:, 50:])
+
+        with self.assertRaises(ValueError):
+            core.get_topo_array(self.lon_ex, self.lat_ex, self.testdir,
+                                out=np.zeros((1, 10, 10)))
+
+    def test_cache_budget(self):
+
+        index = os.path.join(self.testdir, 'cache_index.json')
+        tiles = sorted(glob.glob(os.path.join(self.testdir, '*.tif')))
+        products = []
+        for buffer in [0.5, 1, 2]:
+            fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex,
+                                       self.testdir, crop_buffer=buffer)
+            products.append(fp)
+        # single tiles are not products
+        core.get_topo_file([6, 7], [41, 42], self.testdir)
+        d = core._read_json(index)
+        self.assertEqual(sorted(d.keys()),
+                         sorted(os.path.relpath(p, self.testdir)
+                                for p in products))
+        size = sum(os.path.getsize(p) for p in products)
+        self.assertEqual(sum(e['size'] for e in d.values()), size)
+
+        # the first product was used again lately
+        time.sleep(0.01)
+        core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                           crop_buffer=0.5, cache_budget=size)
+        # the last use is only tracked with a budget
+        atime = core._read_json(index)[os.path.relpath(products[0],
+                                                       self.testdir)]['atime']
+        core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                           crop_buffer=0.5)
+        self.assertEqual(core._read_json(index)[os.path.relpath(
+            products[0], self.testdir)]['atime'], atime)
+
+        # a product being written (here in another thread) is not removed
+        locked, done = threading.Event(), threading.Event()
+
+        def _write():
+            with core.get_file_lock(products[1]):
+                locked.set()
+                done.wait()
+        writer = threading.Thread(target=_write)
+        writer.start()
+        locked.wait()
+        try:
+            removed = core.trim_cache(self.testdir, 0, keep=[products[0]])
+        finally:
+            done.set()
+            writer.join()
+        self.assertEqual(removed, [products[2]])
+
+        fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                   crop_buffer=1, cache_budget=size)
+        self.assertEqual(fp, products[1])
+        self.assertTrue(os.path.exists(products[0]))
+        fp, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                                   crop_buffer=3, cache_budget=0)
+        self.assertTrue(os.path.exists(fp))
+        self.assertFalse(any(os.path.exists(p) for p in products[:2]))
+        self.assertEqual(list(core._read_json(index).keys()),
+                         [os.path.relpath(fp, self.testdir)])
+        self.assertEqual(sorted(glob.glob(os.path.join(self.testdir,
+                                                       '*.tif'))), tiles)
+        # no lock file left behind by the removed products
+        self.assertEqual(glob.glob(os.path.join(self.testdir, 'srtm',
+                                                '*.lock')), [fp + '.lock'])
+
+    def test_dem3_southern_zone(self):
+
+        # the southern archives are extracted in the northern folder
+        ddir = os.path.join(self.testdir, 'dem3_south')
+        core.mkdir(ddir)
+        make_dem3_archive(ddir, 'A30', ['N00W002', 'N00W001'])
+        make_dem3_archive(ddir, 'SA30', ['S01W002', 'S01W001'],
+                          dirname='A30')
+
+        north = core.download_dem3_viewpano('A30', ddir)
+        south = core.download_dem3_viewpano('SA30', ddir)
+        with rasterio.open(north) as ds:
+            self.assertTrue(ds.bounds.bottom > -0.01)
+        with rasterio.open(south) as ds:
+            self.assertTrue(ds.bounds.top < 0.01)
+        # nothing extracted left
+        self.assertEqual(sorted(f for f in os.listdir(ddir)
+                                if not f.endswith('.lock')),
+                         ['A30.tif', 'SA30.tif', 'dem3_A30.zip',
+                          'dem3_SA30.zip'])
+
+    def test_dem3_equator_workers(self):
+
+        # both zones of the equator are worked on at the same time
+        ddir = os.path.join(self.testdir, 'dem3_equator')
+        core.mkdir(ddir)
+        make_dem3_archive(ddir, 'A30', ['N00W002', 'N00W001'])
+        make_dem3_archive(ddir, 'SA30', ['S01W002', 'S01W001'],
+                          dirname='A30')
+        fp, src = core.get_topo_file([-2, -1], [-1, 1], ddir,
+                                     source='DEM3', max_workers=4)
+        self.assertEqual(src, 'DEM3_MERGED')
+        with rasterio.open(fp) as ds:
+            np.testing.assert_allclose(ds.bounds.bottom, -1, atol=0.01)
+            np.testing.assert_allclose(ds.bounds.top, 1, atol=0.01)
+            self.assertFalse(np.any(ds.read() == ds.nodata))
+
+    def test_missing_expiry(self):
+
+        os.remove(os.path.join(self.testdir, 'srtm_38_04.tif'))
+        core._record_missing_tile(self.testdir, 'srtm_38_04.zip')
+        with mock.patch.object(core, '_download_srtm_file_unlocked',
+                               return_value=None) as dl:
+            core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+            core.get_topo_files([self.lon_ex], [self.lat_ex], self.testdir)
+            self.assertEqual(dl.call_count, 0)
+            # the server is asked again
+            core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir,
+                               missing_expiry=0)
+            core.get_topo_files([self.lon_ex], [self.lat_ex], self.testdir,
+                                missing_expiry=0)
+            core.get_topo_array(self.lon_ex, self.lat_ex, self.testdir,
+                                missing_expiry=0)
+            self.assertEqual(dl.call_count, 3)
+
+    def test_mosaic_reuse(self):
+
+        mosaic, _ = core.get_topo_file(self.lon_ex, self.lat_ex,
+                                       self.testdir)
+
+        # a contained extent is cropped from the mosaic
+        for buffer in [0.5, None]:
+            ref, _, _ = core.get_topo_array([8, 11], [43, 44], self.testdir,
+                                            crop_buffer=buffer)
+            with mock.patch.object(core, '_merge_topo_files',
+                                   wraps=core._merge_topo_files) as merge:
+                fp, src = core.get_topo_file([8, 11], [43, 44],
+                                             self.testdir,
+                                             crop_buffer=buffer)
+                self.assertEqual(merge.call_args[0][0], [mosaic])
+            self.assertEqual(src, 'SRTM_MERGED')
+            with rasterio.open(fp) as ds:
+                np.testing.assert_array_equal(ds.read(), ref)
+
+        # or from several of them, as VRT
+        core.trim_cache(self.testdir, 0)
+        self.assertFalse(os.path.exists(mosaic))
+        west, _ = core.get_topo_file([6, 7], [41, 48], self.testdir)
+        east, _ = core.get_topo_file([11, 12], [41, 48], self.testdir)
+        ref, _, _ = core.get_topo_array([8, 11], [43, 46], self.testdir,
+                                        crop_buffer=0.5)
+        fp, _ = core.get_topo_file([8, 11], [43, 46], self.testdir,
+                                   crop_buffer=0.5, output_format='VRT')
+        with rasterio.open(fp) as ds:
+            self.assertEqual(sorted(ds.files[1:]), sorted([west, east]))
+            np.testing.assert_array_equal(ds.read(), ref)
+
+        # which goes away with them
+        core._update_json(os.path.join(self.testdir, 'cache_index.json'),
+                          lambda d: d[os.path.relpath(
+                              west, self.testdir)].update(atime=0))
+        removed = core.trim_cache(self.testdir, os.path.getsize(east))
+        self.assertEqual(sorted(removed), sorted([west, fp]))
+        # with their lock files
+        self.assertFalse(os.path.exists(west + '.lock'))
+        self.assertFalse(os.path.exists(fp + '.lock'))
+
+    def test_mosaic_missing_tile(self):
+
+        # a mosaic merged while a tile was missing on the server
+        os.remove(os.path.join(self.testdir, 'srtm_38_03.tif'))
+        core._record_missing_tile(self.testdir, 'srtm_38_03.zip')
+        mosaic, _ = core.get_topo_file(self.lon_ex, self.lat_ex,
+                                       self.testdir)
+
+        # is not used for this tile once it is there
+        make_srtm_tile(self.testdir, '38_03')
+        with mock.patch.object(core, '_merge_topo_files',
+                               wraps=core._merge_topo_files) as merge:
+            fp, _ = core.get_topo_file([6, 9], [41, 48], self.testdir)
+            self.assertNotIn(mosaic, merge.call_args[0][0])
+        with rasterio.open(fp) as ds:
+            self.assertFalse(np.any(ds.read() == -32768))
+
+    def test_topo_file_from_geometry(self):
+
+        geom = shpg.LineString([(6, 41), (14, 48)]).buffer(0.01)
+        row = gpd.GeoDataFrame({'O1Region': ['11']}, geometry=[geom]).iloc[0]
+        os.remove(os.path.join(self.testdir, 'srtm_38_03.tif'))
+        with mock.patch.object(core, 'download_srtm_file',
+                               wraps=core.download_srtm_file) as dl:
+            fp, src = core.get_topo_file_from_geometry(row, self.testdir)
+            self.assertEqual(sorted(c[0][0] for c in dl.call_args_list),
+                             ['38_04', '39_03', '39_04'])
+        self.assertEqual(src, 'SRTM_MERGED')
+        with rasterio.open(fp) as ds:
+            self.assertEqual(ds.bounds, (5., 40., 15., 50.))
+            dem = ds.read(1)
+        self.assertTrue(np.all(dem[:50, :50] == -32768))
+        self.assertFalse(np.any(dem[50:] == -32768))
+
+        # cropped
+        fp, _ = core.get_topo_file_from_geometry(geom, self.testdir,
+                                                 buffer=0.1, crop_buffer=0)
+        with rasterio.open(fp) as ds:
+            np.testing.assert_allclose(tuple(ds.bounds),
+                                       (5.8, 40.8, 14.2, 48.2))
+
+    def test_geometry_mosaic_not_reused(self):
+
+        # the mosaic of the geometry leaves out the tile 38_03
+        geom = shpg.LineString([(6, 41), (14, 48)]).buffer(0.01)
+        mosaic, _ = core.get_topo_file_from_geometry(geom, self.testdir)
+        index = core._read_json(os.path.join(self.testdir,
+                                             'cache_index.json'))
+        key = os.path.relpath(mosaic, self.testdir)
+        self.assertEqual(index[key]['zones'], ['38_04', '39_03', '39_04'])
+
+        # so the extent of 38_03 is merged from the tiles
+        ref, _, _ = core.get_topo_array([6, 9], [41, 48], self.testdir)
+        self.assertFalse(np.any(ref == -32768))
+        with mock.patch.object(core, '_merge_topo_files',
+                               wraps=core._merge_topo_files) as merge:
+            fp, _ = core.get_topo_file([6, 9], [41, 48], self.testdir)
+            self.assertNotIn(mosaic, merge.call_args[0][0])
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(), ref)
+
+        # but the ones of its tiles can use it
+        with mock.patch.object(core, '_merge_topo_files',
+                               wraps=core._merge_topo_files) as merge:
+            core.get_topo_file([9, 14], [41, 44], self.testdir,
+                               crop_buffer=0)
+            self.assertEqual(merge.call_args[0][0], [mosaic])
+
+    def test_get_topo_files(self):
+
+        lon_ex = [[6, 14], [6, 7], [11, 14], [6, 7]]
+        lat_ex = [[41, 48], [41, 42], [41, 48], [41, 42]]
+        ref = [core.get_topo_file(lon, lat, self.testdir)
+               for lon, lat in zip(lon_ex, lat_ex)]
+
+        with mock.patch.object(core, 'download_srtm_file',
+                               wraps=core.download_srtm_file) as dl:
+            out = core.get_topo_files(lon_ex, lat_ex, self.testdir,
+                                      max_workers=2)
+            # each tile only once
+            self.assertEqual(dl.call_count, 4)
+        self.assertEqual(out, ref)
+
+        with self.assertRaises(ValueError):
+            core.get_topo_files(lon_ex, lat_ex, self.testdir,
+                                source=['SRTM', 'DEM3'])
+
+    def test_aget_topo_file(self):
+
+        ref, _ = core.get_topo_file(self.lon_ex, self.lat_ex, self.testdir)
+        with rasterio.open(ref) as ds:
+            ref = ds.read()
+
+        adir = os.path.join(self.testdir, 'async')
+        core.mkdir(adir)
+        for z in core.srtm_zone(self.lon_ex, self.lat_ex):
+            make_srtm_tile(adir, z)
+
+        async def _run():
+            sem = asyncio.Semaphore(2)
+            return await asyncio.gather(
+                core.aget_topo_file(self.lon_ex, self.lat_ex, adir,
+                                    semaphore=sem),
+                core.aget_topo_file([6, 7], [41, 42], adir, semaphore=sem))
+
+        # (no asyncio.run on python 3.5)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            (fp, src), (fp1, src1) = loop.run_until_complete(_run())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual(src, 'SRTM_MERGED')
+        self.assertEqual(src1, 'SRTM')
+        with rasterio.open(fp) as ds:
+            np.testing.assert_array_equal(ds.read(), ref)
+
+
+class TestClimate(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.join(TEST_DIR, 'climate')
+        core.mkdir(self.testdir, reset=True)
+        self.cru_file = make_cru_file(self.testdir, 'tmp')
+
+    def tearDown(self):
+        pass
+
+    def test_cru_chunked_file(self):
+
+        of = core.get_cru_chunked_file(self.testdir, 'tmp')
+        with netCDF4.Dataset(of) as ds:
+            self.assertEqual(ds['tmp'].chunking(), [24, 8, 8])
+            self.assertTrue(ds['tmp'].filters()['zlib'])
+            self.assertEqual(ds.title, 'CRU TS3.23 Mean Temperature')
+        with xr.open_dataset(self.cru_file) as ref, \
+                xr.open_dataset(of) as ds:
+            xr.testing.assert_identical(ds.load(), ref.load())
+
+        # converted only once
+        with mock.patch.object(core, '_rechunk_cru_file') as conv:
+            self.assertEqual(core.get_cru_chunked_file(self.testdir, 'tmp'),
+                             of)
+            self.assertEqual(conv.call_count, 0)
+
+    def test_cru_subset(self):
+
+        with xr.open_dataset(self.cru_file) as ds:
+            ref = ds.tmp.load()
+
+        da = core.get_cru_subset('tmp', [10, 11], [46, 47], self.testdir)
+        self.assertEqual(da.shape, (24, 2, 2))
+        xr.testing.assert_identical(da, ref.sel(lon=slice(10, 11),
+                                                lat=slice(46, 47)))
+
+        # a point gives the nearest grid point
+        da = core.get_cru_subset('tmp', [10.6, 10.6], [46.4, 46.4],
+                                 self.testdir,
+                                 time_range=('1902-03', '1902-05'))
+        self.assertEqual(da.shape, (3, 1, 1))
+        np.testing.assert_array_equal(da.lon, [10.75])
+        np.testing.assert_array_equal(da.lat, [46.25])
+        xr.testing.assert_identical(
+            da, ref.sel(lon=[10.75], lat=[46.25],
+                        time=slice('1902-03', '1902-05')))
+
+    def test_cru_points(self):
+
+        make_cru_file(self.testdir, 'pre')
+        # in the same chunk, in others, twice the same, on the edges
+        lon = [10.6, 10.9, 12.3, -100.1, 10.6, 179.9, -179.9]
+        lat = [46.4, 46.1, 46.4, 40.1, 46.4, 89.9, -89.9]
+
+        with mock.patch.object(xr.DataArray, 'isel',
+                               autospec=True,
+                               side_effect=xr.DataArray.isel) as isel:
+            ds = core.get_cru_points(lon, lat, self.testdir,
+                                     time_range=('1901-06', '1902-05'))
+            # one read per chunk and variable
+            self.assertEqual(isel.call_count, 2 * 5)
+
+        for var in ['tmp', 'pre']:
+            self.assertEqual(ds[var].shape, (7, 12))
+            with xr.open_dataset(make_cru_file(self.testdir, var)) as ref:
+                for i, (x, y) in enumerate(zip(lon, lat)):
+                    r = ref[var].sel(lon=x, lat=y, method='nearest')
+                    r = r.sel(time=slice('1901-06', '1902-05'))
+                    np.testing.assert_array_equal(ds[var][i], r)
+                    self.assertEqual(ds.lon[i], r.lon)
+                    self.assertEqual(ds.lat[i], r.lat)
+
 
 class TestDataFiles(unittest.TestCase):
 
@@ -118,6 +1171,14 @@ class TestDataFiles(unittest.TestCase):
         # z = utils.dem3_viewpano_zone([-91., -90.], [-72., -68.])
         # self.assertTrue(len(z) == 1)
         # self.assertEqual('SR15', z[0])
+        reg = dict(core.DEM3REG)
+        reg['16-30'] = [-91., -1., -90., -60.]
+        z = core.dem3_viewpano_zone([-91., -90.], [-72., -68.],
+                                    extra_reg=reg)
+        self.assertEqual(['SR15'], z)
+        z = core.dem3_viewpano_zone([-80., -79.], [-72., -68.],
+                                    extra_reg=reg)
+        self.assertEqual(['16-30'], z)
 
         # normal tile
         z = core.dem3_viewpano_zone([-179., -178.], [65., 65.])
@@ -131,6 +1192,73 @@ class TestDataFiles(unittest.TestCase):
         self.assertTrue(len(z) == 9)
         self.assertEqual(ref, z)
 
+        # long extents are not missing any row
+        z = core.dem3_viewpano_zone([0.5, 0.5], [0.5, 40.5])
+        self.assertEqual(len(z), 11)
+        self.assertEqual(z[0], 'A31')
+        self.assertEqual(z[-1], 'K31')
+
+        # across the equator
+        z = core.dem3_viewpano_zone([-1, 1], [-1, 1])
+        self.assertEqual(z, ['A30', 'A31', 'SA30', 'SA31'])
+
+    def test_bbox_index(self):
+
+        boxes = {'a': [0., 20., 0., 20.], 'b': [5., 6., 5., 6.],
+                 'c': [-30., -25., -10., 5.]}
+        idx = core.BBoxIndex(boxes, cell_size=4.)
+        out = idx.containing([1., 5., -29., 50., 19.],
+                             [2., 6., -26., 51., 21.],
+                             [1., 5., -9., 0., 1.],
+                             [2., 6., 4., 1., 2.])
+        self.assertEqual(out, ['a', 'a', 'c', None, None])
+        idx = core.BBoxIndex({'b': boxes['b'], 'a': boxes['a']})
+        self.assertEqual(idx.containing(5.5, 5.7, 5.5, 5.7), ['b'])
+
+    def test_geometry_zones(self):
+
+        self.assertEqual(core.zone_bbox('38_04', 'SRTM'), [5, 10, 40, 45])
+        self.assertEqual(core.zone_bbox('L32', 'DEM3'), [6, 12, 44, 48])
+        self.assertEqual(core.zone_bbox('SA30', 'DEM3'), [-6, 0, -4, 0])
+        self.assertEqual(core.zone_bbox('ISL', 'DEM3'), [-25, -12, 63, 67])
+        self.assertEqual(core.zone_bbox('S01W002', 'ASTER'), [-2, -1, -1, 0])
+
+        # a long diagonal glacier
+        geom = shpg.LineString([(6, 41), (14, 48)]).buffer(0.01)
+        self.assertEqual(core.geometry_zones(geom, 'SRTM'),
+                         ['38_04', '39_03', '39_04'])
+        self.assertEqual(core.geometry_zones(geom, 'DEM3'),
+                         ['K31', 'K32', 'L32', 'L33', 'M33'])
+        zones = core.geometry_zones(geom, 'ASTER')
+        self.assertEqual(len(zones), 20)
+        self.assertIn(('N44E010', 'N40E010'), zones)
+        # for a box, the same as the box zones
+        box = shpg.box(6, 41, 14, 48)
+        self.assertEqual(core.geometry_zones(box, 'SRTM'),
+                         core.srtm_zone([6, 14], [41, 48]))
+        self.assertEqual(core.geometry_zones(box, 'DEM3'),
+                         core.dem3_viewpano_zone([6, 14], [41, 48]))
+
+    def test_batch_zones(self):
+
+        lon_ex = [[6, 14], [-112, -112], [-72, -73]]
+        lat_ex = [[41, 48], [57, 57], [-52, -53]]
+        zones = core.srtm_zones(lon_ex, lat_ex)
+        self.assertEqual(len(zones), 3)
+        for z, lon, lat in zip(zones, lon_ex, lat_ex):
+            self.assertEqual(z, core.srtm_zone(lon, lat))
+
+        zones = core.dem3_viewpano_zones(lon_ex, lat_ex)
+        for z, lon, lat in zip(zones, lon_ex, lat_ex):
+            self.assertEqual(z, core.dem3_viewpano_zone(lon, lat))
+        zones = core.aster_zones(lon_ex, lat_ex)
+        for z, lon, lat in zip(zones, lon_ex, lat_ex):
+            self.assertEqual(z, core.aster_zone(lon, lat))
+
+        # tiles edges belong to the western tile
+        self.assertEqual(core.srtm_zone([-175, -175], [55, 55]), ['01_01'])
+        self.assertEqual(core.srtm_zone([-180, -175], [55, 55]), ['01_01'])
+
     @is_download
     def test_srtmdownload(self):
 